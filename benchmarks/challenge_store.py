@@ -0,0 +1,57 @@
+"""Count session writes for a TOTP login with each challenge store.
+
+Usage: python -m benchmarks.challenge_store
+"""
+from unittest import mock
+
+from . import setup
+from . import setup_db
+
+setup()
+
+import pyotp  # noqa: E402
+from django.contrib.auth.models import User  # noqa: E402
+from django.contrib.sessions.backends.db import SessionStore  # noqa: E402
+from django.test import Client  # noqa: E402
+
+from mfa.methods import totp  # noqa: E402
+from mfa.models import MFAKey  # noqa: E402
+
+STORES = [
+    'mfa.challenges.SessionStore',
+    'mfa.challenges.CacheStore',
+    'mfa.challenges.SignedStore',
+]
+
+
+def login(key):
+    client = Client()
+    client.post('/login/', {'username': 'test', 'password': 'password'})
+    res = client.get('/mfa/auth/TOTP/')
+    token = res.context['form']['challenge'].value()
+    code = pyotp.HOTP(key.secret).at(totp.get_counters()[0])
+    res = client.post('/mfa/auth/TOTP/', {'code': code, 'challenge': token})
+    assert res.status_code == 302, res.status_code
+
+
+def main():
+    setup_db()
+    user = User.objects.create_user('test', password='password')
+    key = MFAKey.objects.create(
+        user=user, method='TOTP', name='test', secret=pyotp.random_base32()
+    )
+
+    for store in STORES:
+        MFAKey.objects.update(last_counter=None)
+        with (
+            mock.patch('mfa.settings.CHALLENGE_STORE', store),
+            mock.patch.object(
+                SessionStore, 'save', autospec=True, side_effect=SessionStore.save
+            ) as save,
+        ):
+            login(key)
+        print(f'{store}: {save.call_count} session writes')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+"""Measure the cost of the main request flows and enforce budgets.
+
+Usage: python -m django test --settings benchmarks.settings benchmarks.flows
+"""
+import sys
+import time
+from unittest import mock
+
+import pyotp
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache
+from django.db import connection
+from django.test import Client
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from mfa.methods import fido2
+from mfa.methods import recovery
+from mfa.methods import totp
+from mfa.models import MFAKey
+from tests.tests import SoftAuthenticator
+
+# Cost per flow. Queries and session writes must match exactly, so any change
+# shows up here. Bytes are a maximum. Time depends on the machine, so it is
+# only reported.
+BUDGETS = {
+    'login_totp': {
+        'queries': 25,
+        'session_writes': 5,
+        'bytes': 600,
+    },
+    'login_totp_combined': {
+        'queries': 12,
+        'session_writes': 2,
+        'bytes': 100,
+    },
+    'login_totp_api': {
+        'queries': 25,
+        'session_writes': 5,
+        'bytes': 200,
+    },
+    'login_fido2': {
+        # includes the usage update, which is coalesced on later logins, and
+        # loading the credential from the primary
+        'queries': 26,
+        'session_writes': 5,
+        'bytes': 1000,
+    },
+    'login_passkey': {
+        # includes loading the user through the authentication backend
+        'queries': 18,
+        'session_writes': 4,
+        'bytes': 1000,
+    },
+    'login_recovery': {
+        'queries': 25,
+        'session_writes': 5,
+        'bytes': 700,
+    },
+    'create_totp': {
+        'queries': 12,
+        'session_writes': 2,
+        'bytes': 6500,
+    },
+    'create_recovery': {
+        'queries': 12,
+        'session_writes': 2,
+        'bytes': 1000,
+    },
+    'create_fido2_begin': {
+        'queries': 6,
+        'session_writes': 1,
+        'bytes': 2000,
+    },
+    'list': {
+        'queries': 3,
+        'session_writes': 0,
+        'bytes': 700,
+    },
+    'enforce_middleware': {
+        'queries': 2,
+        'session_writes': 0,
+        'bytes': 0,
+    },
+}
+
+
+class MeasuringClient(Client):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bytes = 0
+
+    def request(self, **request):
+        response = super().request(**request)
+        self.bytes += len(response.content)
+        return response
+
+
+class FlowBenchmark(TestCase):
+    client_class = MeasuringClient
+    results = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        columns = ['queries', 'session_writes', 'bytes', 'time']
+        print(file=sys.stderr)
+        print(f'{"flow":<20}' + ''.join(f'{c:>16}' for c in columns), file=sys.stderr)
+        for name, result in sorted(cls.results.items()):
+            values = [
+                f'{result[c] * 1000:.1f}ms' if c == 'time' else str(result[c])
+                for c in columns
+            ]
+            print(f'{name:<20}' + ''.join(f'{v:>16}' for v in values), file=sys.stderr)
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('test', password='password')
+
+    def login(self):
+        res = self.client.post('/login/', {
+            'username': 'test',
+            'password': 'password',
+        })
+        self.assertEqual(res.status_code, 302)
+        return res
+
+    def measure(self, name, func):
+        self.client.bytes = 0
+        with (
+            CaptureQueriesContext(connection) as ctx,
+            mock.patch.object(
+                SessionStore, 'save', autospec=True, side_effect=SessionStore.save
+            ) as save,
+        ):
+            start = time.perf_counter()
+            func()
+            duration = time.perf_counter() - start
+
+        result = {
+            'queries': len(ctx.captured_queries),
+            'session_writes': save.call_count,
+            'bytes': self.client.bytes,
+            'time': duration,
+        }
+        self.results[name] = result
+
+        for key, budget in BUDGETS[name].items():
+            with self.subTest(flow=name, metric=key):
+                if key == 'bytes':
+                    self.assertLessEqual(result[key], budget)
+                else:
+                    self.assertEqual(result[key], budget)
+
+    def test_login_totp(self):
+        key = MFAKey.objects.create(
+            user=self.user,
+            method='TOTP',
+            name='test',
+            secret=pyotp.random_base32(),
+        )
+        code = pyotp.HOTP(key.secret).at(totp.get_counters()[0])
+
+        def flow():
+            res = self.login()
+            res = self.client.get(res.url)
+            res = self.client.post(res.request['PATH_INFO'], {'code': code})
+            self.assertEqual(res.status_code, 302)
+
+        self.measure('login_totp', flow)
+
+    def test_login_totp_combined(self):
+        key = MFAKey.objects.create(
+            user=self.user,
+            method='TOTP',
+            name='test',
+            secret=pyotp.random_base32(),
+        )
+        code = pyotp.HOTP(key.secret).at(totp.get_counters()[0])
+
+        def flow():
+            res = self.client.post('/login/code/', {
+                'username': 'test',
+                'password': 'password',
+                'code': code,
+            })
+            self.assertEqual(res.status_code, 302)
+            self.assertEqual(res.url, '/')
+
+        self.measure('login_totp_combined', flow)
+
+    def test_login_totp_api(self):
+        key = MFAKey.objects.create(
+            user=self.user,
+            method='TOTP',
+            name='test',
+            secret=pyotp.random_base32(),
+        )
+        code = pyotp.HOTP(key.secret).at(totp.get_counters()[0])
+
+        def flow():
+            self.login()
+            res = self.client.get('/mfa/api/auth/TOTP/')
+            res = self.client.post('/mfa/api/auth/TOTP/', {
+                'code': code,
+                'challenge': res.json()['challenge'],
+            })
+            self.assertEqual(res.status_code, 200)
+
+        self.measure('login_totp_api', flow)
+
+    def test_login_fido2(self):
+        authenticator = SoftAuthenticator()
+        MFAKey.objects.bulk_create(
+            fido2.build_keys(self.user, 'test', authenticator.secret)
+        )
+
+        def flow():
+            res = self.login()
+            res = self.client.get(res.url)
+            code = authenticator.get(res.context['mfa_data'])
+            res = self.client.post(res.request['PATH_INFO'], {'code': code})
+            self.assertEqual(res.status_code, 302)
+
+        self.measure('login_fido2', flow)
+
+    @mock.patch('mfa.settings.PASSKEY_LOGIN', True)
+    def test_login_passkey(self):
+        authenticator = SoftAuthenticator()
+        MFAKey.objects.bulk_create(
+            fido2.build_keys(self.user, 'test', authenticator.secret)
+        )
+        user_handle = str(self.user.pk).encode()
+
+        def flow():
+            res = self.client.get('/mfa/passkey/')
+            code = authenticator.get(
+                res.context['mfa_data'], user_handle=user_handle
+            )
+            res = self.client.post('/mfa/passkey/', {'code': code})
+            self.assertEqual(res.status_code, 302)
+
+        self.measure('login_passkey', flow)
+
+    def test_login_recovery(self):
+        code = recovery.generate_code()
+        state = [[recovery.get_lookup(code), make_password(code)]]
+        MFAKey.objects.bulk_create(recovery.build_keys(self.user, 'test', state))
+
+        def flow():
+            self.login()
+            self.client.get('/mfa/auth/recovery/')
+            res = self.client.post('/mfa/auth/recovery/', {'code': code})
+            self.assertEqual(res.status_code, 302)
+
+        self.measure('login_recovery', flow)
+
+    def test_create_totp(self):
+        self.client.force_login(self.user)
+
+        def flow():
+            res = self.client.get('/mfa/create/TOTP/')
+            hotp = pyotp.HOTP(res.context['mfa_data']['secret'])
+            res = self.client.post('/mfa/create/TOTP/', {
+                'name': 'test',
+                'code': hotp.at(totp.get_counters()[0]),
+            })
+            self.assertEqual(res.status_code, 302)
+
+        self.measure('create_totp', flow)
+
+    def test_create_recovery(self):
+        self.client.force_login(self.user)
+
+        def flow():
+            res = self.client.get('/mfa/create/recovery/')
+            res = self.client.post('/mfa/create/recovery/', {
+                'name': 'test',
+                'code': res.context['mfa_data']['code'],
+            })
+            self.assertEqual(res.status_code, 302)
+
+        self.measure('create_recovery', flow)
+
+    def test_create_fido2_begin(self):
+        self.client.force_login(self.user)
+
+        def flow():
+            res = self.client.get('/mfa/create/FIDO2/')
+            self.assertEqual(res.status_code, 200)
+
+        self.measure('create_fido2_begin', flow)
+
+    def test_list(self):
+        for method in ['TOTP', 'recovery']:
+            MFAKey.objects.create(
+                user=self.user, method=method, name='test', secret='dummy'
+            )
+        self.client.force_login(self.user)
+
+        def flow():
+            res = self.client.get('/mfa/')
+            self.assertEqual(res.status_code, 200)
+
+        self.measure('list', flow)
+
+    def test_enforce_middleware(self):
+        MFAKey.objects.create(
+            user=self.user, method='TOTP', name='test', secret='dummy'
+        )
+        self.client.force_login(self.user)
+        self.client.get('/')
+
+        def flow():
+            res = self.client.get('/')
+            self.assertEqual(res.status_code, 204)
+
+        self.measure('enforce_middleware', flow)
@@ -0,0 +1,46 @@
+"""Compare the QR code filter to qrcode's rect-per-module SVG output.
+
+Usage: python -m benchmarks.qr
+"""
+from . import setup
+from . import timeit
+
+setup()
+
+import pyotp  # noqa: E402
+import qrcode  # noqa: E402
+import qrcode.image.svg  # noqa: E402
+
+from mfa.templatetags.mfa import get_qrcode  # noqa: E402
+from mfa.templatetags.mfa import render_qrcode  # noqa: E402
+
+URL = pyotp.TOTP(pyotp.random_base32()).provisioning_uri(
+    'someone@example.com', issuer_name='Example'
+)
+
+
+def legacy(url):
+    img = qrcode.make(url, image_factory=qrcode.image.svg.SvgImage)
+    s = img.to_string().decode('utf-8')
+    i = s.find('<svg')
+    return s[i:]
+
+
+def uncached(url):
+    return render_qrcode(url)
+
+
+def main():
+    number = 100
+    for label, func in [
+        ('rect per module', legacy),
+        ('single path', uncached),
+        ('single path, cached', get_qrcode),
+    ]:
+        size = len(func(URL).encode('utf-8'))
+        duration = timeit(lambda f=func: f(URL), number=number)
+        print(f'{label}: {size} bytes, {duration * 1000:.2f}ms per render')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+"""Compare creating a recovery sheet to creating codes one at a time.
+
+Usage: python -m benchmarks.recovery [SIZE]
+"""
+import sys
+from unittest import mock
+
+from . import setup
+from . import timeit
+
+setup()
+
+from django.test import override_settings  # noqa: E402
+
+from mfa.methods import recovery  # noqa: E402
+
+
+def one_at_a_time(size):
+    for _ in range(size):
+        recovery.register_begin(None)
+
+
+def sheet(size):
+    with mock.patch('mfa.settings.RECOVERY_CODES_PER_SHEET', size):
+        recovery.register_begin(None)
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    hashers = ['django.contrib.auth.hashers.PBKDF2PasswordHasher']
+    with override_settings(PASSWORD_HASHERS=hashers):
+        print(f'one at a time: {timeit(lambda: one_at_a_time(size)):.3f}s')
+        print(f'sheet:         {timeit(lambda: sheet(size)):.3f}s')
+
+
+if __name__ == '__main__':
+    main()
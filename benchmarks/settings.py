@@ -0,0 +1,13 @@
+import os
+
+from tests.settings import *  # noqa: F403
+
+# Run against a local PostgreSQL database with BENCHMARK_DB=postgresql.
+# Connection parameters are taken from the usual PG* environment variables.
+if os.environ.get('BENCHMARK_DB') == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('PGDATABASE', 'mfa_benchmarks'),
+        }
+    }
@@ -1,8 +1,13 @@
+from django import forms
 from django.contrib import admin
 from django.contrib.auth import REDIRECT_FIELD_NAME
 from django.contrib.auth.views import redirect_to_login
 from django.urls import reverse
+from django.utils.translation import gettext_lazy as _
+from django.utils.translation import ngettext
 
+from . import settings
+from .cache import invalidate_many
 from .decorators import login_not_required
 from .models import MFAKey
 
@@ -21,8 +26,89 @@ def patch_admin():
     setattr(admin.AdminSite, 'login', custom_login)
 
 
+def get_method_choices():
+    return [(method, method) for method in settings.METHODS]
+
+
+class MethodListFilter(admin.SimpleListFilter):
+    # the default filter would scan the whole table for distinct values
+    title = _('method')
+    parameter_name = 'method'
+
+    def lookups(self, request, model_admin):
+        return get_method_choices()
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(method=self.value())
+
+
+class MFAKeyForm(forms.ModelForm):
+    # the model field has no choices, so that MFA_METHODS can change
+    method = forms.ChoiceField(label=_('method'), choices=get_method_choices)
+
+    class Meta:
+        model = MFAKey
+        fields = '__all__'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # keep existing keys of methods that are no longer enabled editable
+        method = self.instance.method
+        if method and method not in settings.METHODS:
+            self.fields['method'].choices = [
+                *get_method_choices(), (method, method)
+            ]
+
+
+def revoke_keys(modeladmin, request, queryset, method=None):
+    user_ids = set(queryset.values_list('user_id', flat=True))
+    keys = MFAKey.objects.filter(user_id__in=user_ids)
+    if method:
+        keys = keys.filter(method=method)
+    count = keys.raw_delete()
+    invalidate_many(user_ids)
+    modeladmin.message_user(request, ngettext(
+        'Revoked %(count)d key of %(users)d user(s).',
+        'Revoked %(count)d keys of %(users)d user(s).',
+        count,
+    ) % {'count': count, 'users': len(user_ids)})
+
+
 @admin.register(MFAKey)
 class MFAKeyAdmin(admin.ModelAdmin):
-    list_display = ['user', 'method', 'name']
-    search_fields = ['user__username', 'name']
-    list_filter = ['method']
+    form = MFAKeyForm
+    list_display = ['user', 'method', 'name', 'last_used_at']
+    list_select_related = ['user']
+    # prefix search can use the indexes on username and name
+    search_fields = ['user__username__startswith', 'name__startswith']
+    list_filter = [MethodListFilter]
+    show_full_result_count = False
+    actions = ['revoke_all']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).defer('secret')
+
+    @admin.action(
+        description=_('Revoke all keys for selected users'),
+        permissions=['delete'],
+    )
+    def revoke_all(self, request, queryset):
+        revoke_keys(self, request, queryset)
+
+    def get_actions(self, request):
+        actions = super().get_actions(request)
+        if self.has_delete_permission(request):
+            for method in settings.METHODS:
+                name = f'revoke_{method}'
+                description = _('Revoke %(method)s keys for selected users') % {
+                    'method': method,
+                }
+                actions[name] = (
+                    lambda modeladmin, request, queryset, method=method: (
+                        revoke_keys(modeladmin, request, queryset, method)
+                    ),
+                    name,
+                    description,
+                )
+        return actions
@@ -6,5 +6,6 @@ class TwoFactorConfig(AppConfig):
     verbose_name = 'Multi Factor Authentication'
 
     def ready(self):
+        from . import signals  # noqa: F401
         from .admin import patch_admin
         patch_admin()
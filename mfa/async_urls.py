@@ -0,0 +1,26 @@
+from django.urls import path
+
+from .async_views import MFAAuthView
+from .async_views import MFACreateView
+from .decorators import public
+from .views import MFAAuthAPIView
+from .views import MFACreateAPIView
+from .views import MFADeleteView
+from .views import MFAListView
+from .views import PasskeyLoginView
+
+app_name = 'mfa'
+# the remaining views are sync, Django runs them in a worker thread
+urlpatterns = [
+    path('', public(MFAListView.as_view()), name='list'),
+    path('<int:pk>/delete/', public(MFADeleteView.as_view()), name='delete'),
+    path('create/<method>/', public(MFACreateView.as_view()), name='create'),
+    path('auth/<method>/', MFAAuthView.as_view(), name='auth'),
+    path(
+        'api/create/<method>/',
+        public(MFACreateAPIView.as_view()),
+        name='api_create',
+    ),
+    path('api/auth/<method>/', MFAAuthAPIView.as_view(), name='api_auth'),
+    path('passkey/', PasskeyLoginView.as_view(), name='passkey'),
+]
@@ -0,0 +1,336 @@
+"""Async variants of the views for projects running under ASGI.
+
+These views use the async ORM and session APIs and require Django 5.1 or
+later. Password hashing and code verification run in a worker thread so
+they do not block the event loop. Use `mfa.async_urls` instead of `mfa.urls`
+and `mfa.async_views.LoginView` instead of `mfa.views.LoginView`.
+"""
+
+from asgiref.sync import sync_to_async
+from django.conf import settings as django_settings
+from django.contrib import messages
+from django.contrib.auth import alogin
+from django.contrib.auth import get_user_model
+from django.contrib.auth import user_login_failed
+from django.contrib.auth.forms import AuthenticationForm
+from django.contrib.auth.views import RedirectURLMixin
+from django.contrib.auth.views import redirect_to_login
+from django.contrib.sites.shortcuts import get_current_site
+from django.core.exceptions import ValidationError
+from django.http import Http404
+from django.shortcuts import redirect
+from django.shortcuts import resolve_url
+from django.utils.text import format_lazy
+from django.utils.translation import gettext_lazy as _
+from django.views.decorators.cache import never_cache
+from django.views.decorators.csrf import csrf_protect
+from django.views.decorators.debug import sensitive_post_parameters
+from django.views.generic import View
+from django.views.generic.base import ContextMixin
+from django.views.generic.base import TemplateResponseMixin
+
+from . import settings
+from . import throttle
+from .cache import keys_created
+from .cache import set_has_keys
+from .decorators import login_not_required
+from .decorators import stronghold_login_not_required
+from .forms import MFAAuthForm
+from .forms import MFACreateForm
+from .mail import notify_login_failed
+from .mixins import MFAChallengeMixin
+from .models import MFAKey
+from .routers import apin
+from .routers import primary
+from .views import verify_login_code
+
+
+class LoginView(RedirectURLMixin, TemplateResponseMixin, View):
+    """Async counterpart of `mfa.views.LoginView`.
+
+    Supports the same options as Django's `LoginView`: `form_class` or
+    `authentication_form`, `template_name`, `next_page`,
+    `redirect_authenticated_user` and `extra_context`.
+    """
+
+    form_class = AuthenticationForm
+    authentication_form = None
+    template_name = 'registration/login.html'
+    redirect_authenticated_user = False
+    extra_context = None
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        view = sensitive_post_parameters()(csrf_protect(never_cache(view)))
+        return login_not_required(stronghold_login_not_required(view))
+
+    async def dispatch(self, request, *args, **kwargs):
+        if self.redirect_authenticated_user:
+            user = await request.auser()
+            if user.is_authenticated:
+                redirect_to = self.get_success_url()
+                if redirect_to == request.path:
+                    raise ValueError(
+                        'Redirection loop for authenticated user detected. '
+                        "Check that your LOGIN_REDIRECT_URL doesn't point "
+                        'to a login page.'
+                    )
+                return redirect(redirect_to)
+        return await super().dispatch(request, *args, **kwargs)
+
+    def get_default_redirect_url(self):
+        return resolve_url(self.next_page or django_settings.LOGIN_REDIRECT_URL)
+
+    def get_form_class(self):
+        return self.authentication_form or self.form_class
+
+    async def render_form(self, form):
+        current_site = await sync_to_async(get_current_site)(self.request)
+        return self.render_to_response({
+            'form': form,
+            self.redirect_field_name: self.get_redirect_url(),
+            'site': current_site,
+            'site_name': current_site.name,
+            **(self.extra_context or {}),
+        })
+
+    async def get(self, request, *args, **kwargs):
+        return await self.render_form(self.get_form_class()(request))
+
+    async def post(self, request, *args, **kwargs):
+        form = self.get_form_class()(request, data=request.POST)
+        if await sync_to_async(form.is_valid)():
+            return await self.form_valid(form)
+        return await self.render_form(form)
+
+    async def no_key_exists(self, form):
+        await alogin(self.request, form.get_user())
+        return redirect(self.get_success_url())
+
+    async def form_valid(self, form):
+        user = form.get_user()
+        enrolled = {
+            method async for method
+            in user.mfakey_set.values_list('method', flat=True).distinct()
+        }
+        await sync_to_async(set_has_keys)(user.pk, bool(enrolled))
+        if not enrolled:
+            return await self.no_key_exists(form)
+
+        methods = [m for m in settings.METHODS if m in enrolled]
+        code = form.cleaned_data.get('code')
+        if code and 'TOTP' in methods:
+            if await sync_to_async(verify_login_code)(self.request, user, code):
+                await alogin(self.request, user)
+                return redirect(self.get_success_url())
+            methods = ['TOTP', *(m for m in methods if m != 'TOTP')]
+
+        session = self.request.session
+        await session.aset('mfa_user', {
+            'pk': user.pk,
+            'backend': user.backend,
+        })
+        await session.aset('mfa_success_url', self.get_success_url())
+        await session.aset('mfa_methods', methods)
+        if methods:
+            return redirect('mfa:auth', methods[0])
+
+
+class MFAFormView(MFAChallengeMixin, TemplateResponseMixin, ContextMixin, View):
+    form_class = None
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        return sensitive_post_parameters()(never_cache(view))
+
+    async def setup_user(self):
+        raise NotImplementedError  # pragma: no cover
+
+    async def aload_challenge(self):
+        try:
+            return await self.challenge_store.aload(
+                self.request, self.challenge_scope, self.challenge_token
+            )
+        except KeyError as e:
+            raise Http404 from e
+
+    def begin(self):
+        raise NotImplementedError  # pragma: no cover
+
+    def complete(self, state, code):
+        raise NotImplementedError  # pragma: no cover
+
+    async def get_context_data(self, **kwargs):
+        return super().get_context_data(**kwargs)
+
+    async def render_form(self, form, mfa_data=None, status=200):
+        if mfa_data is None:
+            mfa_data, state = await sync_to_async(self.call_method)(
+                'begin', self.begin
+            )
+            token = await self.challenge_store.asave(
+                self.request, self.challenge_scope, (mfa_data, state)
+            )
+            form.initial['challenge'] = token
+        context = await self.get_context_data(form=form, mfa_data=mfa_data)
+        return self.render_to_response(context, status=status)
+
+    async def get(self, request, *args, **kwargs):
+        response = await self.setup_user()
+        if response:
+            return response
+        return await self.render_form(self.form_class())
+
+    async def post(self, request, *args, **kwargs):
+        response = await self.setup_user()
+        if response:
+            return response
+        return await self.process_form(request)
+
+    async def process_form(self, request):
+        challenge = await self.aload_challenge()
+        form = self.form_class(
+            data=request.POST,
+            validate_code=lambda code: self.call_method(
+                'complete', self.complete, challenge[1], code
+            ),
+        )
+        if await sync_to_async(form.is_valid)():
+            try:
+                await self.challenge_store.adelete(
+                    self.request, self.challenge_scope, self.challenge_token
+                )
+            except KeyError as e:
+                raise Http404 from e
+            return await self.form_valid(form)
+        return await self.form_invalid(form, challenge)
+
+    async def form_invalid(self, form, challenge, status=200):
+        # do not generate a new challenge
+        return await self.render_form(form, challenge[0], status=status)
+
+
+class MFACreateView(MFAFormView):
+    form_class = MFACreateForm
+    flow = 'create'
+
+    def get_template_names(self):
+        return self.method.create_template
+
+    @property
+    def challenge_scope(self):
+        return f'create:{self.method.name}:{self.user.pk}'
+
+    async def setup_user(self):
+        self.user = await self.request.auser()
+        if not self.user.is_authenticated:
+            return redirect_to_login(self.request.get_full_path())
+
+    def begin(self):
+        return self.method.register_begin(self.user)
+
+    def complete(self, state, code):
+        return self.method.register_complete(state, code)
+
+    async def form_valid(self, form):
+        keys = self.method.build_keys(
+            self.user,
+            form.cleaned_data['name'],
+            form.cleaned_data['secret'],
+        )
+        if settings.MAX_KEYS_PER_ACCOUNT:
+            with primary():
+                count = await self.user.mfakey_set.acount()
+            if count + len(keys) > settings.MAX_KEYS_PER_ACCOUNT:
+                form.add_error(None, format_lazy(_(
+                    'You cannot have more than {} keys. Please delete '
+                    'one of your existing keys before adding a new one.'
+                ), settings.MAX_KEYS_PER_ACCOUNT))
+                return await self.render_form(form)
+        await MFAKey.objects.abulk_create(keys)
+        # bulk_create() does not send post_save
+        await sync_to_async(keys_created)(self.user.pk)
+        await apin(self.request)
+        messages.success(self.request, _('Key was created successfully!'))
+        return redirect('mfa:list')
+
+
+class MFAAuthView(MFAFormView):
+    form_class = MFAAuthForm
+    flow = 'auth'
+    throttled = False
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        return login_not_required(stronghold_login_not_required(view))
+
+    def get_template_names(self):
+        return self.method.auth_template
+
+    @property
+    def challenge_scope(self):
+        return f'auth:{self.method.name}:{self.user.pk}'
+
+    async def setup_user(self):
+        user_data = await self.request.session.aget('mfa_user')
+        if user_data is None:
+            raise Http404
+        User = get_user_model()
+        self.user = await User._default_manager.filter(
+            pk=user_data['pk']
+        ).afirst()
+        if self.user is None:
+            raise Http404
+        self.user.backend = user_data['backend']
+
+    async def get_context_data(self, **kwargs):
+        context = await super().get_context_data(**kwargs)
+        context['mfa_methods'] = await self.request.session.aget(
+            'mfa_methods', settings.METHODS
+        )
+        return context
+
+    async def post(self, request, *args, **kwargs):
+        response = await self.setup_user()
+        if response:
+            return response
+        self.throttled = not await sync_to_async(throttle.attempt)(
+            request, self.user, self.method.cost
+        )
+        return await self.process_form(request)
+
+    def begin(self):
+        return self.method.authenticate_begin(self.user)
+
+    def complete(self, state, code):
+        if self.throttled:
+            raise ValidationError(
+                _('Too many attempts. Please try again later.'),
+                code='throttled',
+            )
+        return self.method.authenticate_complete(state, self.user, code)
+
+    async def form_invalid(self, form, challenge):
+        if self.throttled:
+            return await super().form_invalid(form, challenge, status=429)
+        await user_login_failed.asend(
+            sender=__name__,
+            credentials={'username': self.user.get_username()},
+            request=self.request,
+        )
+        await sync_to_async(notify_login_failed)(self.user, self.method)
+        return await super().form_invalid(form, challenge)
+
+    async def form_valid(self, form):
+        session = self.request.session
+        success_url = await session.apop('mfa_success_url')
+        await alogin(self.request, self.user)
+        await session.apop('mfa_user')
+        await session.apop('mfa_methods', None)
+        if self.method.name == 'recovery':
+            return redirect('mfa:list')
+        return redirect(success_url)
+
@@ -0,0 +1,45 @@
+from django.core.cache import caches
+
+from . import settings
+
+
+def get_cache():
+    return caches[settings.CACHE]
+
+
+def has_keys_key(user_id):
+    return f'mfa:has_keys:{user_id}'
+
+
+def credentials_key(user_id):
+    return f'mfa:fido2_credentials:{user_id}'
+
+
+def has_keys(user):
+    cache = get_cache()
+    value = cache.get(has_keys_key(user.pk))
+    if value is None:
+        value = user.mfakey_set.exists()
+        cache.set(has_keys_key(user.pk), value, settings.CACHE_TIMEOUT)
+    return value
+
+
+def set_has_keys(user_id, value):
+    get_cache().set(has_keys_key(user_id), value, settings.CACHE_TIMEOUT)
+
+
+def invalidate(user_id):
+    invalidate_many([user_id])
+
+
+def invalidate_many(user_ids):
+    get_cache().delete_many([
+        key
+        for user_id in user_ids
+        for key in [has_keys_key(user_id), credentials_key(user_id)]
+    ])
+
+
+def keys_created(user_id):
+    invalidate(user_id)
+    set_has_keys(user_id, True)
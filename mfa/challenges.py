@@ -0,0 +1,141 @@
+import secrets
+
+from django.core import signing
+
+from . import settings
+from .cache import get_cache
+
+
+class SessionStore:
+    """Keep the challenges in the session (default), one per scope."""
+
+    key = 'mfa_challenges'
+
+    def save(self, request, scope, challenge):
+        challenges = request.session.get(self.key, {})
+        challenges[scope] = challenge
+        request.session[self.key] = challenges
+        return ''
+
+    def load(self, request, scope, token):
+        return request.session.get(self.key, {})[scope]
+
+    def delete(self, request, scope, token):
+        challenges = request.session.get(self.key, {})
+        del challenges[scope]
+        request.session[self.key] = challenges
+
+    async def asave(self, request, scope, challenge):
+        challenges = await request.session.aget(self.key, {})
+        challenges[scope] = challenge
+        await request.session.aset(self.key, challenges)
+        return ''
+
+    async def aload(self, request, scope, token):
+        return (await request.session.aget(self.key, {}))[scope]
+
+    async def adelete(self, request, scope, token):
+        challenges = await request.session.aget(self.key, {})
+        del challenges[scope]
+        await request.session.aset(self.key, challenges)
+
+
+class CacheStore:
+    """Keep the challenge in the cache and pass a random token in the form."""
+
+    def get_key(self, scope, token):
+        return f'mfa:challenge:{scope}:{token}'
+
+    def save(self, request, scope, challenge):
+        token = secrets.token_urlsafe()
+        get_cache().set(
+            self.get_key(scope, token), challenge, settings.CHALLENGE_TIMEOUT
+        )
+        return token
+
+    def load(self, request, scope, token):
+        challenge = get_cache().get(self.get_key(scope, token))
+        if challenge is None:
+            raise KeyError(token)
+        return challenge
+
+    def delete(self, request, scope, token):
+        # only the first request that deletes the challenge may use it
+        if not get_cache().delete(self.get_key(scope, token)):
+            raise KeyError(token)
+
+    async def asave(self, request, scope, challenge):
+        token = secrets.token_urlsafe()
+        await get_cache().aset(
+            self.get_key(scope, token), challenge, settings.CHALLENGE_TIMEOUT
+        )
+        return token
+
+    async def aload(self, request, scope, token):
+        challenge = await get_cache().aget(self.get_key(scope, token))
+        if challenge is None:
+            raise KeyError(token)
+        return challenge
+
+    async def adelete(self, request, scope, token):
+        if not await get_cache().adelete(self.get_key(scope, token)):
+            raise KeyError(token)
+
+
+class SignedStore:
+    """Pass the signed challenge in the form.
+
+    Only a marker for used challenges is kept in the cache.
+    """
+
+    salt = 'mfa.challenges.SignedStore'
+
+    def get_used_key(self, nonce):
+        return f'mfa:challenge_used:{nonce}'
+
+    def save(self, request, scope, challenge):
+        return signing.dumps(
+            [scope, secrets.token_urlsafe(12), challenge],
+            salt=self.salt,
+            compress=True,
+        )
+
+    def _load(self, scope, token):
+        try:
+            signed_scope, nonce, challenge = signing.loads(
+                token, salt=self.salt, max_age=settings.CHALLENGE_TIMEOUT
+            )
+        except signing.BadSignature as e:
+            raise KeyError(token) from e
+        if signed_scope != scope:
+            raise KeyError(token)
+        return nonce, challenge
+
+    def load(self, request, scope, token):
+        nonce, challenge = self._load(scope, token)
+        if get_cache().get(self.get_used_key(nonce)):
+            raise KeyError(token)
+        return challenge
+
+    def delete(self, request, scope, token):
+        nonce, _challenge = self._load(scope, token)
+        if not get_cache().add(
+            self.get_used_key(nonce), True, settings.CHALLENGE_TIMEOUT
+        ):
+            raise KeyError(token)
+
+    async def asave(self, request, scope, challenge):
+        return self.save(request, scope, challenge)
+
+    async def aload(self, request, scope, token):
+        nonce, challenge = self._load(scope, token)
+        if await get_cache().aget(self.get_used_key(nonce)):
+            raise KeyError(token)
+        return challenge
+
+    async def adelete(self, request, scope, token):
+        nonce, _challenge = self._load(scope, token)
+        if not await get_cache().aadd(
+            self.get_used_key(nonce), True, settings.CHALLENGE_TIMEOUT
+        ):
+            raise KeyError(token)
@@ -1,9 +1,11 @@
 from django import forms
+from django.contrib.auth.forms import AuthenticationForm
 from django.utils.translation import gettext_lazy as _
 
 
 class MFABaseForm(forms.Form):
     code = forms.CharField(label=_('Authentication code'))
+    challenge = forms.CharField(required=False, widget=forms.HiddenInput)
 
     def __init__(self, validate_code=None, **kwargs):
         self.validate_code = validate_code
@@ -29,3 +31,13 @@ class MFAAuthForm(MFABaseForm):
 
 class MFACreateForm(MFABaseForm):
     name = forms.CharField(label=_('Name for this key'), max_length=32)
+
+
+class MFALoginForm(AuthenticationForm):
+    """Login form with an optional TOTP code, see `LoginView`."""
+
+    code = forms.CharField(label=_('Authentication code'), required=False)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['code'].widget.attrs.update({'autocomplete': 'one-time-code'})
@@ -1,15 +1,29 @@
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth import get_user_model
 from django.core.mail import EmailMultiAlternatives
+from django.db import connections
 from django.template import TemplateDoesNotExist
 from django.template import loader
+from django.utils.module_loading import import_string
 
+from . import metrics
 from . import settings
+from .cache import get_cache
 
 SUBJECT_TEMPLATE = 'mfa/login_failed_subject.txt'
 BODY_TEMPLATE = 'mfa/login_failed_email.txt'
 HTML_TEMPLATE = 'mfa/login_failed_email.html'
 
+_executor = None
+_executor_lock = threading.Lock()
+
 
-def send_mail(user, method):
+def _send_mail(user, method_name, count):
     email_field_name = user.get_email_field_name()
     user_email = getattr(user, email_field_name)
     if not user_email:
@@ -20,7 +34,8 @@ def send_mail(user, method):
         'domain': settings.DOMAIN,
         'site_name': settings.SITE_TITLE,
         'user': user,
-        'method': method.name,
+        'method': method_name,
+        'count': count,
     }
 
     try:
@@ -43,4 +58,125 @@ def send_mail(user, method):
     except TemplateDoesNotExist:
         pass
 
-    return message.send()
+    with metrics.measure('mail', method=method_name):
+        return message.send()
+
+
+def send_mail(user, method, count=1):
+    return _send_mail(user, method.name, count)
+
+
+def get_pending_key(user_id):
+    return f'mfa:failed_logins:{user_id}'
+
+
+def send_digest(user_id, method_name):
+    """Send a single email for all failed attempts since the first one."""
+    cache = get_cache()
+    key = get_pending_key(user_id)
+    count = cache.get(key)
+    cache.delete(key)
+    if not count:
+        return 0
+
+    User = get_user_model()
+    try:
+        user = User._default_manager.get(pk=user_id)
+    except User.DoesNotExist:
+        return 0
+    return _send_mail(user, method_name, count)
+
+
+def get_window_key(user_id):
+    return f'mfa:failed_logins_window:{user_id}'
+
+
+def notify_login_failed(user, method):
+    cache = get_cache()
+    key = get_pending_key(user.pk)
+    # The first attempt in a window is reported right away, later ones are
+    # combined into a digest at the end of the window.
+    if cache.add(get_window_key(user.pk), 1, settings.MAIL_WINDOW):
+        delay = 0
+    else:
+        delay = settings.MAIL_WINDOW
+    # The entry has to outlive the window so send_digest() can read it.
+    # The margin also covers slow task queues.
+    if cache.add(key, 1, settings.MAIL_WINDOW + 600):
+        dispatch = import_string(settings.MAIL_DISPATCHER)
+        dispatch(send_digest, user.pk, method.name, delay=delay)
+    else:
+        try:
+            cache.incr(key)
+        except ValueError:
+            # the digest has just been sent
+            notify_login_failed(user, method)
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=2, thread_name_prefix='mfa-mail'
+            )
+        return _executor
+
+
+def _run_in_thread(func, *args):
+    try:
+        func(*args)
+    finally:
+        connections.close_all()
+
+
+class Scheduler:
+    """Submit delayed calls to the executor from a single thread.
+
+    The thread is a daemon, so calls that are still pending are lost when
+    the process exits.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.queue = []
+        self.counter = itertools.count()
+        self.thread = None
+
+    def schedule(self, delay, func, *args):
+        due = time.monotonic() + delay
+        with self.condition:
+            heapq.heappush(self.queue, (due, next(self.counter), func, args))
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name='mfa-mail-scheduler', daemon=True
+                )
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue or self.queue[0][0] > time.monotonic():
+                    timeout = None
+                    if self.queue:
+                        timeout = self.queue[0][0] - time.monotonic()
+                    self.condition.wait(timeout)
+                _due, _count, func, args = heapq.heappop(self.queue)
+            get_executor().submit(_run_in_thread, func, *args)
+
+
+_scheduler = Scheduler()
+
+
+def dispatch_in_thread(func, *args, delay=0):
+    """Run `func(*args)` in a background thread after `delay` seconds."""
+    if delay:
+        _scheduler.schedule(delay, func, *args)
+    else:
+        get_executor().submit(_run_in_thread, func, *args)
+
+
+def dispatch_sync(func, *args, delay=0):
+    """Run `func(*args)` immediately, which disables coalescing."""
+    func(*args)
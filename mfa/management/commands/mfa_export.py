@@ -0,0 +1,71 @@
+import csv
+import json
+import os
+import sys
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from ...models import MFAKey
+
+FIELDS = ['username', 'method', 'name', 'secret', 'lookup']
+
+
+def open_private(path):
+    """Open a file for writing that only the owner can read."""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    return open(fd, 'w', newline='', encoding='utf-8')
+
+
+class Command(BaseCommand):
+    help = 'Export MFA keys to a JSONL or CSV file (see mfa_import).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='output file or "-" for stdout')
+        parser.add_argument('--format', choices=['jsonl', 'csv'])
+        parser.add_argument('--method', action='append', dest='methods')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, path, **options):
+        fmt = options['format']
+        if fmt is None:
+            fmt = 'csv' if path.endswith('.csv') else 'jsonl'
+
+        start = time.monotonic()
+        if path == '-':
+            count = self.export(sys.stdout, fmt, options)
+            report = self.stderr
+        else:
+            with open_private(path) as f:
+                count = self.export(f, fmt, options)
+            report = self.stdout
+        duration = time.monotonic() - start
+
+        rate = count / duration if duration else 0
+        report.write(
+            f'Exported {count} keys in {duration:.1f}s ({rate:.0f} keys/s)'
+        )
+
+    def export(self, f, fmt, options):
+        User = get_user_model()
+        keys = MFAKey.objects.order_by('pk')
+        if options['methods']:
+            keys = keys.filter(method__in=options['methods'])
+        rows = keys.values_list(
+            f'user__{User.USERNAME_FIELD}', 'method', 'name', 'secret', 'lookup'
+        ).iterator(chunk_size=options['chunk_size'])
+
+        if fmt == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(FIELDS)
+            write = writer.writerow
+        else:
+            def write(row):
+                f.write(json.dumps(dict(zip(FIELDS, row, strict=True))) + '\n')
+
+        count = 0
+        for row in rows:
+            write(row)
+            count += 1
+        return count
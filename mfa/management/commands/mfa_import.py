@@ -0,0 +1,151 @@
+import base64
+import csv
+import itertools
+import json
+import sys
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from ... import settings
+from ...cache import invalidate_many
+from ...methods import get_method
+from ...methods import recovery
+from ...models import MFAKey
+
+
+def read_records(f, fmt):
+    if fmt == 'csv':
+        yield from csv.DictReader(f)
+    else:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def hex_to_base32(secret):
+    return base64.b32encode(bytes.fromhex(secret)).decode('ascii')
+
+
+class Command(BaseCommand):
+    help = (
+        'Import MFA keys from a JSONL or CSV file with the fields username, '
+        'method, name, secret and (for recovery codes) lookup.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='input file or "-" for stdin')
+        parser.add_argument('--format', choices=['jsonl', 'csv'])
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--totp-hex',
+            action='store_true',
+            help='TOTP secrets are hex encoded (e.g. django-otp)',
+        )
+        parser.add_argument(
+            '--hash-recovery-codes',
+            action='store_true',
+            help='recovery secrets are plain codes that need to be hashed',
+        )
+
+    def handle(self, path, **options):
+        fmt = options['format']
+        if fmt is None:
+            fmt = 'csv' if path.endswith('.csv') else 'jsonl'
+        self.options = options
+        self.imported = 0
+        self.skipped = 0
+
+        start = time.monotonic()
+        if path == '-':
+            self.import_records(read_records(sys.stdin, fmt))
+        else:
+            with open(path, newline='', encoding='utf-8') as f:
+                self.import_records(read_records(f, fmt))
+        duration = time.monotonic() - start
+
+        rate = self.imported / duration if duration else 0
+        self.stdout.write(
+            f'Imported {self.imported} keys ({self.skipped} skipped) '
+            f'in {duration:.1f}s ({rate:.0f} keys/s)'
+        )
+
+    def import_records(self, records):
+        records = enumerate(records, 1)
+        while batch := list(itertools.islice(
+            records, self.options['batch_size']
+        )):
+            self.import_batch(batch)
+
+    def skip(self, lineno, reason):
+        self.skipped += 1
+        self.stderr.write(f'record {lineno}: {reason}')
+
+    def get_secret(self, record):
+        secret = record['secret']
+        if record['method'] == 'TOTP' and self.options['totp_hex']:
+            return hex_to_base32(secret)
+        if record['method'] == 'recovery':
+            return [[record.get('lookup') or '', secret]]
+        return secret
+
+    def hash_recovery_codes(self, batch):
+        records = [
+            record for _lineno, record in batch
+            if record.get('method') == 'recovery' and record.get('secret')
+        ]
+        if not records:
+            return
+        hashes = recovery.hash_codes([record['secret'] for record in records])
+        for record, hashed in zip(records, hashes, strict=True):
+            record['lookup'] = recovery.get_lookup(record['secret'])
+            record['secret'] = hashed
+
+    def import_batch(self, batch):
+        User = get_user_model()
+        usernames = {record.get('username') for _lineno, record in batch}
+        users = {
+            user.get_username(): user
+            for user in User._default_manager.filter(
+                **{f'{User.USERNAME_FIELD}__in': usernames}
+            )
+        }
+        counts = dict(
+            MFAKey.objects.filter(user__in=users.values())
+            .values_list('user').annotate(Count('id'))
+        )
+        if self.options['hash_recovery_codes']:
+            self.hash_recovery_codes(batch)
+
+        keys = []
+        for lineno, record in batch:
+            user = users.get(record.get('username'))
+            if user is None:
+                self.skip(lineno, 'unknown user')
+                continue
+            try:
+                method = get_method(record['method'])
+                user_keys = method.build_keys(
+                    user, record['name'], self.get_secret(record)
+                )
+            except (KeyError, ValueError, TypeError) as e:
+                self.skip(lineno, f'invalid record ({e!r})')
+                continue
+            count = counts.get(user.pk, 0) + len(user_keys)
+            if (
+                settings.MAX_KEYS_PER_ACCOUNT
+                and count > settings.MAX_KEYS_PER_ACCOUNT
+            ):
+                self.skip(lineno, 'too many keys')
+                continue
+            counts[user.pk] = count
+            keys += user_keys
+
+        with transaction.atomic():
+            MFAKey.objects.bulk_create(keys)
+        # bulk_create() does not send post_save
+        invalidate_many({key.user_id for key in keys})
+        self.imported += len(keys)
@@ -0,0 +1,178 @@
+import itertools
+import json
+import multiprocessing
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import get_hasher
+from django.contrib.auth.hashers import identify_hasher
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import transaction
+from django.db.models import Count
+
+from ... import settings
+from ...cache import invalidate_many
+from ...methods import recovery
+from ...models import MFAKey
+from .mfa_export import open_private
+
+
+def find_outdated(rows):
+    """Return algorithm counts and `(pk, user_id)` of outdated hashes."""
+    preferred = get_hasher('default')
+    algorithms = Counter()
+    outdated = []
+    for pk, user_id, encoded in rows:
+        try:
+            hasher = identify_hasher(encoded)
+        except ValueError:
+            algorithms['unknown'] += 1
+            outdated.append((pk, user_id))
+            continue
+        algorithms[hasher.algorithm] += 1
+        if (
+            hasher.algorithm != preferred.algorithm
+            or preferred.must_update(encoded)
+        ):
+            outdated.append((pk, user_id))
+    return algorithms, outdated
+
+
+def generate_sheet(user_id):
+    return user_id, *recovery.generate_sheet()
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+
+class Command(BaseCommand):
+    help = (
+        'Find recovery codes that are hashed with an outdated algorithm or '
+        'work factor and optionally delete or replace them.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000)
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='number of processes',
+        )
+        parser.add_argument(
+            '--invalidate',
+            action='store_true',
+            help='delete outdated recovery codes',
+        )
+        parser.add_argument(
+            '--reissue',
+            metavar='PATH',
+            help=(
+                'delete outdated recovery codes and write new sheets for the '
+                'affected users to PATH (JSONL)'
+            ),
+        )
+        parser.add_argument('--name', default='recovery')
+
+    def handle(self, **options):
+        if options['reissue'] == '-':
+            raise CommandError('Refusing to write recovery codes to stdout.')
+
+        start = time.monotonic()
+        executor = None
+        if options['workers'] > 1:
+            # do not share the open database connection with the workers
+            executor = ProcessPoolExecutor(
+                options['workers'],
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=django.setup,
+            )
+        map_ = executor.map if executor else map
+        try:
+            rows = MFAKey.objects.filter(method=recovery.name).values_list(
+                'pk', 'user_id', 'secret'
+            ).iterator(chunk_size=options['chunk_size'])
+
+            algorithms = Counter()
+            outdated = []
+            for counts, chunk_outdated in map_(
+                find_outdated, chunked(rows, options['chunk_size'])
+            ):
+                algorithms.update(counts)
+                outdated += chunk_outdated
+
+            for algorithm, count in sorted(algorithms.items()):
+                self.stdout.write(f'{algorithm}: {count}')
+            user_ids = sorted({user_id for _pk, user_id in outdated})
+            self.stdout.write(
+                f'{len(outdated)} outdated codes of {len(user_ids)} users'
+            )
+
+            if options['invalidate'] or options['reissue']:
+                self.delete(outdated, options)
+            if options['reissue']:
+                self.reissue(user_ids, map_, options)
+        finally:
+            if executor:
+                executor.shutdown()
+
+        duration = time.monotonic() - start
+        self.stdout.write(f'Finished in {duration:.1f}s')
+
+    def delete(self, outdated, options):
+        for chunk in chunked(outdated, options['chunk_size']):
+            keys = MFAKey.objects.filter(pk__in=[pk for pk, _user_id in chunk])
+            # a single DELETE without loading the keys or sending signals
+            keys.raw_delete()
+            invalidate_many({user_id for _pk, user_id in chunk})
+        self.stdout.write(f'Deleted {len(outdated)} codes')
+
+    def reissue(self, user_ids, map_, options):
+        User = get_user_model()
+        count = 0
+        over_limit = []
+        with open_private(options['reissue']) as f:
+            for chunk in chunked(user_ids, options['chunk_size']):
+                users = User._default_manager.in_bulk(chunk)
+                key_counts = dict(
+                    MFAKey.objects.filter(user_id__in=chunk)
+                    .values_list('user_id')
+                    .annotate(Count('pk'))
+                )
+                keys = []
+                sheets = []
+                for user_id, codes, state in map_(generate_sheet, chunk):
+                    user = users.get(user_id)
+                    if user is None:
+                        continue
+                    if (
+                        settings.MAX_KEYS_PER_ACCOUNT
+                        and key_counts.get(user_id, 0) + len(state)
+                        > settings.MAX_KEYS_PER_ACCOUNT
+                    ):
+                        over_limit.append(user.get_username())
+                        continue
+                    keys += recovery.build_keys(user, options['name'], state)
+                    sheets.append({
+                        'username': user.get_username(),
+                        'codes': codes,
+                    })
+                with transaction.atomic():
+                    MFAKey.objects.bulk_create(keys)
+                invalidate_many(users)
+                for sheet in sheets:
+                    f.write(json.dumps(sheet) + '\n')
+                count += len(sheets)
+        self.stdout.write(f'Issued {count} new sheets')
+        if over_limit:
+            self.stderr.write(
+                f'Skipped {len(over_limit)} users who would exceed '
+                f'MFA_MAX_KEYS_PER_ACCOUNT: {", ".join(over_limit)}'
+            )
@@ -0,0 +1,48 @@
+import contextvars
+import functools
+from importlib import import_module
+from importlib.metadata import entry_points
+
+from .. import settings
+
+# Relative cost of verifying a code. Attempts are weighed by this when
+# throttling.
+COST_LOW = 1
+COST_HIGH = 2
+
+# Host of the current request, set by the views for methods that depend on
+# it (e.g. FIDO2 with `MFA_RELYING_PARTIES`)
+current_host = contextvars.ContextVar('mfa_current_host', default=None)
+
+
+class ReplayError(ValueError):
+    """A valid code that has already been used."""
+
+
+BUILTIN_METHODS = {
+    'FIDO2': 'mfa.methods.fido2',
+    'TOTP': 'mfa.methods.totp',
+    'recovery': 'mfa.methods.recovery',
+}
+
+
+@functools.cache
+def get_registry():
+    """Map method names to module paths.
+
+    Third party packages can register methods using the `mfa.methods`
+    entry point group. `MFA_METHOD_MODULES` takes precedence.
+    """
+    registry = dict(BUILTIN_METHODS)
+    for entry_point in entry_points(group='mfa.methods'):
+        registry[entry_point.name] = entry_point.value
+    registry.update(settings.METHOD_MODULES)
+    return registry
+
+
+def get_method(name):
+    # Modules are only imported on first use so that unused backends
+    # (and their dependencies) do not slow down startup.
+    if name not in settings.METHODS:
+        raise KeyError(name)
+    return import_module(get_registry()[name])
@@ -1,47 +1,137 @@
+import functools
+import hashlib
 import json
 
+from django.core.exceptions import DisallowedHost
+from django.http.request import split_domain_port
 from fido2.server import Fido2Server
 from fido2.utils import websafe_decode
 from fido2.utils import websafe_encode
 from fido2.webauthn import AttestedCredentialData
+from fido2.webauthn import AuthenticationResponse
 from fido2.webauthn import PublicKeyCredentialRpEntity
 from fido2.webauthn import PublicKeyCredentialUserEntity
+from fido2.webauthn import ResidentKeyRequirement
+from fido2.webauthn import UserVerificationRequirement
 
 from .. import settings
+from ..cache import credentials_key
+from ..cache import get_cache
+from ..models import MFAKey
+from ..routers import primary
+from ..usage import record_use
+from . import COST_LOW
+from . import current_host
 
 name = 'FIDO2'
+auth_template = 'mfa/auth_FIDO2.html'
+create_template = 'mfa/create_FIDO2.html'
+cost = COST_LOW
 
-fido2 = Fido2Server(
-    PublicKeyCredentialRpEntity(id=settings.DOMAIN, name=settings.SITE_TITLE),
-)
+
+def get_relying_party(host):
+    """Return `(id, name)` of the relying party for a request host."""
+    if host is None or not settings.RELYING_PARTIES:
+        return settings.DOMAIN, settings.SITE_TITLE
+    domain, _port = split_domain_port(host)
+    if callable(settings.RELYING_PARTIES):
+        relying_party = settings.RELYING_PARTIES(domain)
+    else:
+        relying_party = settings.RELYING_PARTIES.get(domain)
+    if relying_party is None:
+        raise DisallowedHost(f'No FIDO2 relying party for {domain!r}')
+    rp_id, rp_name = relying_party
+    return rp_id, rp_name
+
+
+@functools.lru_cache(maxsize=settings.FIDO2_SERVER_CACHE_SIZE)
+def _get_server(rp_id, rp_name):
+    return Fido2Server(PublicKeyCredentialRpEntity(id=rp_id, name=rp_name))
+
+
+def get_server():
+    return _get_server(*get_relying_party(current_host.get()))
+
+
+def get_credential_id(raw_id):
+    return hashlib.sha256(raw_id).hexdigest()
+
+
+def parse_secret(secret):
+    return AttestedCredentialData(websafe_decode(secret))
 
 
 def get_credentials(user):
-    keys = user.mfakey_set.filter(method=name)
-    return [AttestedCredentialData(websafe_decode(key.secret)) for key in keys]
+    """Return a dict of parsed credentials by credential ID."""
+    cache = get_cache()
+    credentials = cache.get(credentials_key(user.pk))
+    if credentials is None:
+        keys = user.mfakey_set.filter(method=name)
+        credentials = {
+            credential_id: parse_secret(secret)
+            for credential_id, secret
+            in keys.values_list('credential_id', 'secret')
+        }
+        cache.set(
+            credentials_key(user.pk), credentials, settings.CACHE_TIMEOUT
+        )
+    return credentials
+
+
+def get_credential(user, credential_id):
+    """Return the parsed credential from the primary database.
+
+    Unlike `get_credentials()`, this does not use the cache: it might be
+    local to the process or filled from a lagging replica, so it could still
+    contain a credential that has been deleted.
+    """
+    with primary():
+        secret = user.mfakey_set.filter(
+            method=name, credential_id=credential_id
+        ).values_list('secret', flat=True).first()
+    if secret is not None:
+        return parse_secret(secret)
 
 
 def register_begin(user):
-    registration_data, state = fido2.register_begin(
+    registration_data, state = get_server().register_begin(
         PublicKeyCredentialUserEntity(
             id=str(user.id).encode('utf-8'),
             name=user.get_username(),
             display_name=user.get_full_name(),
         ),
-        get_credentials(user),
+        list(get_credentials(user).values()),
+        # discoverable credentials can be used for passkey login
+        resident_key_requirement=(
+            ResidentKeyRequirement.PREFERRED
+            if settings.PASSKEY_LOGIN else None
+        ),
         user_verification=settings.FIDO2_USER_VERIFICATION,
     )
     return json.dumps(dict(registration_data)), state
 
 
 def register_complete(state, request_data):
-    auth_data = fido2.register_complete(state, json.loads(request_data))
+    auth_data = get_server().register_complete(
+        state, json.loads(request_data)
+    )
     return websafe_encode(auth_data.credential_data)
 
 
+def build_keys(user, key_name, secret):
+    credential = parse_secret(secret)
+    return [MFAKey(
+        user=user,
+        method=name,
+        name=key_name,
+        secret=secret,
+        credential_id=get_credential_id(credential.credential_id),
+    )]
+
+
 def authenticate_begin(user):
-    credentials = get_credentials(user)
-    auth_data, state = fido2.authenticate_begin(
+    credentials = list(get_credentials(user).values())
+    auth_data, state = get_server().authenticate_begin(
         credentials,
         user_verification=settings.FIDO2_USER_VERIFICATION,
     )
@@ -49,8 +139,54 @@ def authenticate_begin(user):
 
 
 def authenticate_complete(state, user, request_data):
-    fido2.authenticate_complete(
-        state,
-        get_credentials(user),
-        json.loads(request_data),
+    response = AuthenticationResponse.from_dict(json.loads(request_data))
+    credential_id = get_credential_id(response.raw_id)
+    credential = get_credential(user, credential_id)
+    if credential is None:
+        raise ValueError
+    get_server().authenticate_complete(state, [credential], response)
+    record_use(
+        user.mfakey_set.filter(method=name, credential_id=credential_id),
+        f'{user.pk}:{credential_id}',
+    )
+
+
+def passkey_begin():
+    """Start a login without a known user.
+
+    The empty list of allowed credentials lets the browser offer any
+    discoverable credential for this relying party.
+    """
+    auth_data, state = get_server().authenticate_begin(
+        [], user_verification=UserVerificationRequirement.REQUIRED
+    )
+    return json.dumps(dict(auth_data)), state
+
+
+def passkey_complete(state, request_data):
+    """Return the user that owns the asserted credential.
+
+    The key is found through the indexed `credential_id` column. Raises
+    `ValueError` if there is no such key or the assertion is invalid.
+    """
+    response = AuthenticationResponse.from_dict(json.loads(request_data))
+    credential_id = get_credential_id(response.raw_id)
+    key = MFAKey.objects.filter(
+        method=name, credential_id=credential_id
+    ).select_related('user').first()
+    if key is None:
+        raise ValueError
+    # the authenticator also reports the user it stored with the credential
+    if response.response.user_handle != str(key.user_id).encode('utf-8'):
+        raise ValueError
+    # Do not rely on the state: the key is the only factor, so it must have
+    # verified the user.
+    if not response.response.authenticator_data.is_user_verified():
+        raise ValueError
+    get_server().authenticate_complete(
+        state, [parse_secret(key.secret)], response
+    )
+    record_use(
+        MFAKey.objects.filter(pk=key.pk), f'{key.user_id}:{credential_id}'
     )
+    return key.user
@@ -1,33 +1,102 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import pyotp
+from django.conf import settings as django_settings
 from django.contrib.auth.hashers import check_password
 from django.contrib.auth.hashers import make_password
+from django.db.models import Q
+from django.utils.crypto import salted_hmac
+
+from .. import settings
+from ..models import MFAKey
+from . import COST_HIGH
+from . import ReplayError
 
 name = 'recovery'
+auth_template = 'mfa/auth_recovery.html'
+create_template = 'mfa/create_recovery.html'
+cost = COST_HIGH
 
 
-def register_begin(user):
+def get_lookup(code, secret=None):
+    # A short prefix of a keyed hash. It narrows the search down to (usually)
+    # a single key without revealing anything useful about the code.
+    return salted_hmac(
+        'mfa.methods.recovery', code, secret=secret
+    ).hexdigest()[:8]
+
+
+def get_lookups(code):
+    # codes created before a key rotation were stored with an older key
+    secrets = [django_settings.SECRET_KEY, *django_settings.SECRET_KEY_FALLBACKS]
+    return [get_lookup(code, secret) for secret in secrets]
+
+
+def generate_code():
     secret = pyotp.random_base32()
     totp = pyotp.TOTP(secret, digits=10)
     code = totp.now()
-    code = f'{code[:5]}-{code[5:]}'
-    state = make_password(code)
-    return {'code': code}, state
+    return f'{code[:5]}-{code[5:]}'
+
+
+def hash_codes(codes):
+    if len(codes) == 1:
+        return [make_password(codes[0])]
+    # hashlib releases the GIL while hashing, so threads run in parallel
+    workers = min(len(codes), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(make_password, codes))
+
+
+def generate_sheet():
+    """Return new codes and the matching `[lookup, hash]` pairs."""
+    codes = [generate_code() for _ in range(settings.RECOVERY_CODES_PER_SHEET)]
+    state = [
+        [get_lookup(code), hashed]
+        for code, hashed in zip(codes, hash_codes(codes), strict=True)
+    ]
+    return codes, state
+
+
+def register_begin(user):
+    codes, state = generate_sheet()
+    return {'code': codes[0], 'codes': codes}, state
 
 
 def register_complete(state, request_data):
-    if not check_password(request_data, state):
+    # it is sufficient to confirm the first code of the sheet
+    if not check_password(request_data, state[0][1]):
         raise ValueError
     return state
 
 
+def build_keys(user, key_name, secret):
+    return [
+        MFAKey(
+            user=user, method=name, name=key_name, secret=hashed, lookup=lookup
+        )
+        for lookup, hashed in secret
+    ]
+
+
 def authenticate_begin(user):
     return None, None
 
 
 def authenticate_complete(state, user, request_data):
-    keys = user.mfakey_set.filter(method=name)
+    # keys without lookup were created before it was introduced
+    keys = user.mfakey_set.filter(method=name).filter(
+        Q(lookup__in=get_lookups(request_data)) | Q(lookup='')
+    ).only('user_id', 'secret')
     for key in keys:
         if check_password(request_data, key.secret):
-            key.delete()
-            return
+            # Codes are single use, so there is nothing to rehash. Use
+            # mfa_recovery_audit to replace codes with outdated hashes.
+            # The keys might have been read from a lagging replica, so only
+            # accept the code if this request actually deleted it.
+            deleted, _ = key.delete()
+            if deleted:
+                return
+            raise ReplayError
     raise ValueError
@@ -1,8 +1,24 @@
+import time
+
 import pyotp
+from django.db.models import F
+from django.db.models import Q
+from django.utils import timezone
+from pyotp.utils import strings_equal
 
 from .. import settings
+from ..models import MFAKey
+from . import COST_LOW
+from . import ReplayError
 
 name = 'TOTP'
+auth_template = 'mfa/auth_TOTP.html'
+create_template = 'mfa/create_TOTP.html'
+cost = COST_LOW
+
+# pyotp defaults
+DIGITS = 6
+INTERVAL = 30
 
 
 def register_begin(user):
@@ -22,17 +38,44 @@ def register_complete(state, request_data):
     return state
 
 
+def build_keys(user, key_name, secret):
+    return [MFAKey(user=user, method=name, name=key_name, secret=secret)]
+
+
 def authenticate_begin(user):
     return None, None
 
 
+def get_counters(for_time=None):
+    if for_time is None:
+        for_time = time.time()
+    counter = int(for_time) // INTERVAL
+    window = settings.TOTP_VALID_WINDOW
+    return range(counter - window, counter + window + 1)
+
+
+def accept_counter(key_id, counter):
+    # Atomic check-and-set, so concurrent requests cannot both accept
+    # the same code. The row is written anyway, so also record usage.
+    return MFAKey.objects.filter(pk=key_id).filter(
+        Q(last_counter__isnull=True) | Q(last_counter__lt=counter)
+    ).update(
+        last_counter=counter,
+        last_used_at=timezone.now(),
+        use_count=F('use_count') + 1,
+    )
+
+
 def authenticate_complete(state, user, request_data):
-    keys = user.mfakey_set.filter(method=name)
-    for key in keys:
-        totp = pyotp.TOTP(key.secret)
-        if (totp.verify(request_data, valid_window=settings.TOTP_VALID_WINDOW)
-                and request_data != key.last_code):
-            key.last_code = request_data
-            key.save()
-            return
+    if len(request_data) != DIGITS or not request_data.isdigit():
+        raise ValueError
+    counters = get_counters()
+    keys = user.mfakey_set.filter(method=name).values_list('pk', 'secret')
+    for pk, secret in keys:
+        hotp = pyotp.HOTP(secret, digits=DIGITS)
+        for counter in counters:
+            if strings_equal(request_data, hotp.at(counter)):
+                if accept_counter(pk, counter):
+                    return
+                raise ReplayError
     raise ValueError
@@ -0,0 +1,197 @@
+import bisect
+import contextlib
+import functools
+import threading
+import time
+
+from django.conf import settings as django_settings
+from django.core.exceptions import ValidationError
+from django.db import connections
+from django.dispatch import Signal
+from django.http import Http404
+from django.http import HttpResponse
+from django.utils.module_loading import import_string
+
+from . import settings
+from .decorators import login_not_required
+from .decorators import public
+from .decorators import stronghold_login_not_required
+from .methods import ReplayError
+
+# Sent for every recorded value with the arguments `kind` ("counter" or
+# "histogram"), `name`, `labels` and `value`.
+metric_recorded = Signal()
+
+BUCKETS = {
+    'seconds': (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    'queries': (0, 1, 2, 5, 10, 20, 50),
+}
+
+
+def format_labels(labels, **extra):
+    items = [*labels, *extra.items()]
+    if not items:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in items) + '}'
+
+
+class Registry:
+    """Keep counters and histograms in memory for `metrics_view`.
+
+    Values are per process, so each worker needs to be scraped separately.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(labels.items()))
+        buckets = BUCKETS[name.rsplit('_', 1)[1]]
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = [[0] * len(buckets), 0, 0]
+            histogram = self.histograms[key]
+            index = bisect.bisect_left(buckets, value)
+            if index < len(buckets):
+                histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def render(self):
+        """Return all values in the Prometheus text format."""
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(
+                (key, [list(counts), total, count])
+                for key, (counts, total, count) in self.histograms.items()
+            )
+
+        types = set()
+        for (name, labels), value in counters:
+            if name not in types:
+                types.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{format_labels(labels)} {value}')
+        for (name, labels), (counts, total, count) in histograms:
+            if name not in types:
+                types.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            buckets = BUCKETS[name.rsplit('_', 1)[1]]
+            cumulative = 0
+            for le, bucket_count in zip(buckets, counts, strict=True):
+                cumulative += bucket_count
+                label_str = format_labels(labels, le=le)
+                lines.append(f'{name}_bucket{label_str} {cumulative}')
+            label_str = format_labels(labels, le='+Inf')
+            lines.append(f'{name}_bucket{label_str} {count}')
+            lines.append(f'{name}_sum{format_labels(labels)} {total}')
+            lines.append(f'{name}_count{format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+@functools.cache
+def get_backend(path):
+    return import_string(path)
+
+
+def inc(name, value=1, **labels):
+    if settings.METRICS is None:
+        return
+    get_backend(settings.METRICS).inc(name, labels, value)
+    metric_recorded.send(
+        sender=__name__, kind='counter', name=name, labels=labels, value=value
+    )
+
+
+def observe(name, value, **labels):
+    if settings.METRICS is None:
+        return
+    get_backend(settings.METRICS).observe(name, labels, value)
+    metric_recorded.send(
+        sender=__name__, kind='histogram', name=name, labels=labels, value=value
+    )
+
+
+def get_outcome(exc):
+    if exc is None:
+        return 'success'
+    if isinstance(exc, ReplayError):
+        return 'replay'
+    if isinstance(exc, ValidationError) and exc.code == 'throttled':
+        return 'throttled'
+    return 'failure'
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+@contextlib.contextmanager
+def measure(name, **labels):
+    """Record duration, database queries and outcome of a block.
+
+    This records the histograms `mfa_<name>_seconds` and
+    `mfa_<name>_queries` and the counter `mfa_<name>_total` with an
+    additional `outcome` label.
+    """
+    if settings.METRICS is None:
+        yield
+        return
+
+    counter = QueryCounter()
+    exc = None
+    with contextlib.ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(counter))
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            exc = e
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            observe(f'mfa_{name}_seconds', duration, **labels)
+            observe(f'mfa_{name}_queries', counter.count, **labels)
+            inc(f'mfa_{name}_total', **labels, outcome=get_outcome(exc))
+
+
+@public
+@login_not_required
+@stronghold_login_not_required
+def metrics_view(request):
+    """Expose `registry` for local scraping.
+
+    Only available to `INTERNAL_IPS` and superusers.
+    """
+    if settings.METRICS != 'mfa.metrics.registry':
+        raise Http404
+    if not (
+        request.META.get('REMOTE_ADDR') in django_settings.INTERNAL_IPS
+        or request.user.is_superuser
+    ):
+        raise Http404
+    return HttpResponse(
+        registry.render(), content_type='text/plain; version=0.0.4'
+    )
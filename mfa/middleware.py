@@ -1,12 +1,28 @@
 from django.shortcuts import redirect
 from django.utils.deprecation import MiddlewareMixin
 
+from . import settings
+from .cache import has_keys
+from .routers import is_pinned
+from .routers import primary
+
 
 class MFAEnforceMiddleware(MiddlewareMixin):
     def process_view(self, request, view_func, view_args, view_kwargs):
         if (
             not getattr(view_func, 'mfa_public', False)
             and request.user.is_authenticated
-            and not request.user.mfakey_set.exists()
+            and not has_keys(request.user)
         ):
             return redirect('mfa:list')
+
+
+class MFAPrimaryPinMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if settings.READ_DATABASE and is_pinned(request):
+            with primary():
+                return self.get_response(request)
+        return self.get_response(request)
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mfa', '0004_alter_mfakey_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mfakey',
+            name='lookup',
+            field=models.CharField(blank=True, db_index=True, max_length=8),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mfa', '0005_mfakey_lookup'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='mfakey',
+            name='last_code',
+        ),
+        migrations.AddField(
+            model_name='mfakey',
+            name='last_counter',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
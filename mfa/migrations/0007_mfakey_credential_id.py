@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:50
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def set_credential_id(apps, schema_editor):
+    # imported here so that loading migrations does not require fido2
+    from fido2.utils import websafe_decode
+    from fido2.webauthn import AttestedCredentialData
+
+    MFAKey = apps.get_model('mfa', 'MFAKey')
+    keys = []
+    for key in MFAKey.objects.filter(method='FIDO2').iterator():
+        try:
+            credential = AttestedCredentialData(websafe_decode(key.secret))
+        except Exception:
+            continue
+        key.credential_id = hashlib.sha256(credential.credential_id).hexdigest()
+        keys.append(key)
+    MFAKey.objects.bulk_update(keys, ['credential_id'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mfa', '0006_mfakey_last_counter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mfakey',
+            name='credential_id',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.RunPython(set_credential_id, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mfa', '0007_mfakey_credential_id'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='mfakey',
+            name='method',
+            field=models.CharField(max_length=32),
+        ),
+    ]
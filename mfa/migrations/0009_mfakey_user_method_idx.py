@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:00
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mfa', '0008_alter_mfakey_method'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='mfakey',
+            index=models.Index(fields=['user', 'method'], name='mfa_mfakey_user_method_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mfa', '0009_mfakey_user_method_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mfakey',
+            name='last_used_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='mfakey',
+            name='use_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
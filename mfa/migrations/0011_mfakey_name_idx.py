@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mfa', '0010_mfakey_last_used_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='mfakey',
+            name='name',
+            field=models.CharField(db_index=True, max_length=32),
+        ),
+    ]
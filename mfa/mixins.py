@@ -1,31 +1,62 @@
+import functools
+
 from django.http import Http404
+from django.http import JsonResponse
+from django.http.response import HttpResponseRedirectBase
 from django.utils.decorators import method_decorator
+from django.utils.functional import cached_property
+from django.utils.module_loading import import_string
 from django.views.decorators.cache import never_cache
+from django.views.decorators.csrf import csrf_protect
+from django.views.decorators.csrf import ensure_csrf_cookie
 from django.views.decorators.debug import sensitive_post_parameters
 from django.views.generic import FormView
 
+from . import metrics
 from . import settings
-from .methods import fido2
-from .methods import recovery
-from .methods import totp
+from .methods import current_host
+from .methods import get_method
 
 
-class MFAFormView(FormView):
+class MFAChallengeMixin:
     @property
     def method(self):
-        if self.kwargs['method'] in settings.METHODS:
-            if self.kwargs['method'] == 'FIDO2':
-                return fido2
-            elif self.kwargs['method'] == 'TOTP':
-                return totp
-            elif self.kwargs['method'] == 'recovery':
-                return recovery
-        raise Http404
+        try:
+            return get_method(self.kwargs['method'])
+        except KeyError as e:
+            raise Http404 from e
+
+    @cached_property
+    def challenge_store(self):
+        return import_string(settings.CHALLENGE_STORE)()
+
+    @property
+    def challenge_scope(self):
+        raise NotImplementedError  # pragma: no cover
 
     @property
+    def challenge_token(self):
+        return self.request.POST.get('challenge', '')
+
+    def call_method(self, phase, func, *args):
+        """Run `begin` or `complete` with metrics and the request host."""
+        token = current_host.set(self.request.get_host())
+        try:
+            with metrics.measure(
+                phase, method=self.method.name, flow=self.flow
+            ):
+                return func(*args)
+        finally:
+            current_host.reset(token)
+
+
+class MFAFormView(MFAChallengeMixin, FormView):
+    @cached_property
     def challenge(self):
         try:
-            return self.request.session['mfa_challenge']
+            return self.challenge_store.load(
+                self.request, self.challenge_scope, self.challenge_token
+            )
         except KeyError as e:
             raise Http404 from e
 
@@ -43,14 +74,19 @@ class MFAFormView(FormView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         if 'mfa_data' not in context:
-            data, state = self.begin()
-            self.request.session['mfa_challenge'] = (data, state)
+            data, state = self.call_method('begin', self.begin)
+            token = self.challenge_store.save(
+                self.request, self.challenge_scope, (data, state)
+            )
+            context['form'].initial['challenge'] = token
             context['mfa_data'] = data
         return context
 
     def get_form_kwargs(self):
         kwargs = super().get_form_kwargs()
-        kwargs['validate_code'] = self.complete
+        kwargs['validate_code'] = functools.partial(
+            self.call_method, 'complete', self.complete
+        )
         return kwargs
 
     def form_invalid(self, form):
@@ -60,5 +96,41 @@ class MFAFormView(FormView):
         ))
 
     def form_valid(self, form):
-        del self.request.session['mfa_challenge']
+        try:
+            self.challenge_store.delete(
+                self.request, self.challenge_scope, self.challenge_token
+            )
+        except KeyError as e:
+            raise Http404 from e
         return super().form_valid(form)
+
+
+class MFAJSONMixin:
+    """Respond with JSON instead of templates and redirects."""
+
+    raise_exception = True
+
+    @method_decorator(csrf_protect)
+    @method_decorator(ensure_csrf_cookie)
+    def dispatch(self, *args, **kwargs):
+        return super().dispatch(*args, **kwargs)
+
+    def render_to_response(self, context, **response_kwargs):
+        form = context['form']
+        data = {
+            'method': self.method.name,
+            'mfa_data': context['mfa_data'],
+            'challenge': form['challenge'].value() or '',
+        }
+        if 'mfa_methods' in context:
+            data['methods'] = context['mfa_methods']
+        if form.is_bound and form.errors:
+            data['errors'] = form.errors.get_json_data()
+            response_kwargs.setdefault('status', 400)
+        return JsonResponse(data, **response_kwargs)
+
+    def form_valid(self, form):
+        response = super().form_valid(form)
+        if isinstance(response, HttpResponseRedirectBase):
+            return JsonResponse({'redirect': response.url})
+        return response
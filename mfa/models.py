@@ -1,5 +1,18 @@
 from django.conf import settings
 from django.db import models
+from django.db import router
+
+
+class MFAKeyQuerySet(models.QuerySet):
+    def raw_delete(self):
+        """Delete with a single query on the primary database.
+
+        Unlike `delete()`, this does not load the keys or send signals, so
+        the caller needs to invalidate the cache. `_raw_delete()` is private
+        API, but stable in all supported Django versions (4.2 to 6.0).
+        """
+        alias = router.db_for_write(self.model)
+        return self.using(alias)._raw_delete(alias)
 
 
 class MFAKey(models.Model):
@@ -7,12 +20,25 @@ class MFAKey(models.Model):
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL, on_delete=models.CASCADE
     )
-    method = models.CharField(max_length=8, choices=[
-        ('FIDO2', 'FIDO2'),
-        ('TOTP', 'TOTP'),
-        ('recovery', 'recovery'),
-    ])
-    name = models.CharField(max_length=32)
+    # see mfa.methods.get_registry()
+    method = models.CharField(max_length=32)
+    name = models.CharField(max_length=32, db_index=True)
     secret = models.TextField()
-    # replay protection
-    last_code = models.CharField(max_length=32, blank=True)
+    # non-secret identifier to find a key without checking all secrets
+    lookup = models.CharField(max_length=8, blank=True, db_index=True)
+    # sha256 of the FIDO2 credential ID, which can be too long for an index
+    credential_id = models.CharField(max_length=64, blank=True, db_index=True)
+    # replay protection: TOTP time step of the last accepted code
+    last_counter = models.BigIntegerField(null=True, blank=True)
+    # usage statistics, see mfa.usage
+    last_used_at = models.DateTimeField(null=True, blank=True)
+    use_count = models.PositiveIntegerField(default=0)
+
+    objects = MFAKeyQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['user', 'method'], name='mfa_mfakey_user_method_idx'
+            ),
+        ]
@@ -0,0 +1,69 @@
+import contextlib
+import contextvars
+import time
+
+from django.db import DEFAULT_DB_ALIAS
+
+from . import settings
+
+_primary = contextvars.ContextVar('mfa_primary', default=False)
+
+
+@contextlib.contextmanager
+def primary():
+    """Send all MFA reads within this block to the primary database."""
+    token = _primary.set(True)
+    try:
+        yield
+    finally:
+        _primary.reset(token)
+
+
+def pin(request):
+    """Read from the primary database for the next few requests.
+
+    Use this after modifying keys so the user sees their own changes
+    even if the replica lags behind.
+    """
+    if settings.READ_DATABASE:
+        request.session['mfa_primary_until'] = (
+            time.time() + settings.READ_DATABASE_PIN
+        )
+
+
+async def apin(request):
+    if settings.READ_DATABASE:
+        await request.session.aset(
+            'mfa_primary_until', time.time() + settings.READ_DATABASE_PIN
+        )
+
+
+def is_pinned(request):
+    return request.session.get('mfa_primary_until', 0) > time.time()
+
+
+def is_routed(model):
+    return settings.READ_DATABASE and model._meta.app_label == 'mfa'
+
+
+class MFARouter:
+    """Send reads of MFA models to `MFA_READ_DATABASE`.
+
+    Writes always go to the default database, even for objects that were
+    read from the replica.
+    """
+
+    def db_for_read(self, model, **hints):
+        if is_routed(model) and not _primary.get():
+            return settings.READ_DATABASE
+        return None
+
+    def db_for_write(self, model, **hints):
+        if is_routed(model):
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if is_routed(obj1) or is_routed(obj2):
+            return True
+        return None
@@ -7,9 +7,23 @@ DOMAIN = settings.MFA_DOMAIN
 # Site title that is shown in authenticator apps
 SITE_TITLE = settings.MFA_SITE_TITLE
 
+# FIDO2 relying parties for serving several domains from one deployment:
+# a dict that maps request hosts (without port) to `(rp_id, name)`, or a
+# callable that takes the host and returns `(rp_id, name)` or `None`.
+# Requests from other hosts are rejected. If empty, `DOMAIN` and
+# `SITE_TITLE` are used for all requests.
+RELYING_PARTIES = getattr(settings, 'MFA_RELYING_PARTIES', {})
+
+# Maximum number of FIDO2 servers (one per relying party) kept in memory
+FIDO2_SERVER_CACHE_SIZE = getattr(settings, 'MFA_FIDO2_SERVER_CACHE_SIZE', 64)
+
 # Available authentication methods in order of relevance
 METHODS = getattr(settings, 'MFA_METHODS', ['FIDO2', 'TOTP', 'recovery'])
 
+# Additional method modules by name, e.g. `{'HOTP': 'myapp.mfa_hotp'}`.
+# See `mfa/methods/totp.py` for the interface these modules need to provide.
+METHOD_MODULES = getattr(settings, 'MFA_METHOD_MODULES', {})
+
 # `valid_window` parameter passed to PyOTP's verify method
 # See https://pyauth.github.io/pyotp/#pyotp.totp.TOTP.verify
 TOTP_VALID_WINDOW = getattr(settings, 'MFA_TOTP_VALID_WINDOW', 0)
@@ -18,6 +32,11 @@ TOTP_VALID_WINDOW = getattr(settings, 'MFA_TOTP_VALID_WINDOW', 0)
 # See https://www.w3.org/TR/webauthn/#enum-userVerificationRequirement
 FIDO2_USER_VERIFICATION = getattr(settings, 'MFA_FIDO2_USER_VERIFICATION', None)
 
+# Allow login with a discoverable FIDO2 credential ("passkey") alone, see
+# `mfa.views.PasskeyLoginView`. New FIDO2 keys are created as discoverable
+# credentials if the authenticator supports it.
+PASSKEY_LOGIN = getattr(settings, 'MFA_PASSKEY_LOGIN', False)
+
 # An account might end up having a large number of keys
 # if it is shared by multiple users or if lost keys are not
 # deleted. Both are potential security issues, so this is
@@ -26,3 +45,68 @@ FIDO2_USER_VERIFICATION = getattr(settings, 'MFA_FIDO2_USER_VERIFICATION', None)
 # This setting only applies when adding new keys.
 # To allow an arbitrary number of keys, set this to `None`.
 MAX_KEYS_PER_ACCOUNT = getattr(settings, 'MFA_MAX_KEYS_PER_ACCOUNT', 3)
+
+# Number of recovery codes that are created at once. Each code is stored as
+# a separate key, so make sure that `MAX_KEYS_PER_ACCOUNT` is large enough.
+RECOVERY_CODES_PER_SHEET = getattr(settings, 'MFA_RECOVERY_CODES_PER_SHEET', 1)
+
+# `MFAKey.last_used_at` is only written if it is older than this many
+# seconds. `MFAKey.use_count` is buffered in the cache in between.
+USAGE_GRANULARITY = getattr(settings, 'MFA_USAGE_GRANULARITY', 3600)
+
+# Database alias that `mfa.routers.MFARouter` uses for reads that can
+# tolerate replication lag. After modifying keys, a user's reads are pinned
+# to the primary for `READ_DATABASE_PIN` seconds (requires
+# `mfa.middleware.MFAPrimaryPinMiddleware`).
+READ_DATABASE = getattr(settings, 'MFA_READ_DATABASE', None)
+READ_DATABASE_PIN = getattr(settings, 'MFA_READ_DATABASE_PIN', 30)
+
+# Dotted path to an object with `inc(name, labels, value)` and
+# `observe(name, labels, value)` methods that records metrics, e.g.
+# `mfa.metrics.registry` for the built-in registry that
+# `mfa.metrics.metrics_view` exposes. `None` disables metrics.
+METRICS = getattr(settings, 'MFA_METRICS', None)
+
+# Cache alias used for short-lived MFA state, e.g. whether a user has any keys
+CACHE = getattr(settings, 'MFA_CACHE', 'default')
+
+# Seconds until cached MFA state expires. This bounds how long a server can
+# act on stale state, e.g. a cache that was not invalidated because it is not
+# shared between processes.
+CACHE_TIMEOUT = getattr(settings, 'MFA_CACHE_TIMEOUT', 60)
+
+# Where challenges are kept between rendering a form and submitting it:
+# - `mfa.challenges.SessionStore` keeps them in the session
+# - `mfa.challenges.CacheStore` keeps them in the cache
+# - `mfa.challenges.SignedStore` puts them into the form, signed
+# The latter two require `{{ form.challenge }}` in the templates.
+CHALLENGE_STORE = getattr(
+    settings, 'MFA_CHALLENGE_STORE', 'mfa.challenges.SessionStore'
+)
+
+# Seconds until a challenge expires (not used by the session store)
+CHALLENGE_TIMEOUT = getattr(settings, 'MFA_CHALLENGE_TIMEOUT', 300)
+
+# Failed login attempts of a user within this many seconds are reported in
+# a single email
+MAIL_WINDOW = getattr(settings, 'MFA_MAIL_WINDOW', 300)
+
+# Callable `dispatch(func, *args, delay)` that runs `func(*args)` after
+# `delay` seconds. The default uses a background thread. You can use this
+# to send emails from a task queue instead. `mfa.mail.dispatch_sync` sends
+# emails immediately.
+MAIL_DISPATCHER = getattr(
+    settings, 'MFA_MAIL_DISPATCHER', 'mfa.mail.dispatch_in_thread'
+)
+
+# Maximum number of authentication attempts per user and per client IP
+# within `THROTTLE_WINDOW` seconds. Set to `None` to disable.
+THROTTLE_USER_ATTEMPTS = getattr(settings, 'MFA_THROTTLE_USER_ATTEMPTS', 10)
+THROTTLE_IP_ATTEMPTS = getattr(settings, 'MFA_THROTTLE_IP_ATTEMPTS', 50)
+THROTTLE_WINDOW = getattr(settings, 'MFA_THROTTLE_WINDOW', 300)
+
+# How to get the client IP for throttling: a key of `request.META` or a
+# callable that takes the request. Behind a reverse proxy, use the header
+# that the proxy sets, e.g. `'HTTP_X_FORWARDED_FOR'` (the last address in
+# the header is used). Otherwise all clients share a single limit.
+CLIENT_IP = getattr(settings, 'MFA_CLIENT_IP', 'REMOTE_ADDR')
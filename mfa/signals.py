@@ -0,0 +1,17 @@
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from . import cache
+from .models import MFAKey
+
+
+@receiver(post_save, sender=MFAKey)
+def key_saved(sender, instance, **kwargs):
+    cache.keys_created(instance.user_id)
+
+
+@receiver(post_delete, sender=MFAKey)
+def key_deleted(sender, instance, **kwargs):
+    # other keys might still exist, so let the next request find out
+    cache.invalidate(instance.user_id)
@@ -1,14 +1,83 @@
-import qrcode
-import qrcode.image.svg
+import threading
+import time
+from collections import OrderedDict
+
 from django import template
 from django.utils.safestring import mark_safe
 
+from .. import metrics
+
 register = template.Library()
 
+# Recent results are kept for forms that are rendered again. The data
+# contains TOTP secrets, so entries expire after a short time.
+CACHE_SIZE = 32
+CACHE_TIMEOUT = 60
+
+# least recently used first
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def render_qrcode(data):
+    import qrcode
+
+    qr = qrcode.QRCode(border=4)
+    qr.add_data(data)
+    qr.make(fit=True)
+    matrix = qr.get_matrix()
+    size = len(matrix)
+
+    # a single path with one rectangle per horizontal run of dark modules
+    path = []
+    for y, row in enumerate(matrix):
+        x = 0
+        while x < size:
+            if row[x]:
+                start = x
+                while x < size and row[x]:
+                    x += 1
+                path.append(f'M{start} {y}h{x - start}v1H{start}z')
+            else:
+                x += 1
+
+    return (
+        '<svg xmlns="http://www.w3.org/2000/svg" '
+        f'viewBox="0 0 {size} {size}" width="{size}mm" height="{size}mm" '
+        'shape-rendering="crispEdges">'
+        f'<path d="{"".join(path)}"/>'
+        '</svg>'
+    )
+
+
+def cache_clear():
+    with _cache_lock:
+        _cache.clear()
+
+
+def render_qrcode_cached(data):
+    now = time.monotonic()
+    with _cache_lock:
+        entry = _cache.get(data)
+        if entry is not None and entry[0] > now:
+            _cache.move_to_end(data)
+            return entry[1]
+
+    svg = render_qrcode(data)
+    with _cache_lock:
+        # hits do not extend the expiry, so the order does not tell which
+        # entries have expired
+        expired = [key for key, entry in _cache.items() if entry[0] <= now]
+        for key in expired:
+            del _cache[key]
+        _cache[data] = (now + CACHE_TIMEOUT, svg)
+        _cache.move_to_end(data)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return svg
+
 
 @register.filter(name='qrcode')
 def get_qrcode(url):
-    img = qrcode.make(url, image_factory=qrcode.image.svg.SvgImage)
-    s = img.to_string().decode('utf-8')
-    i = s.find('<svg')
-    return mark_safe(s[i:])
+    with metrics.measure('qrcode'):
+        return mark_safe(render_qrcode_cached(url))
@@ -0,0 +1,68 @@
+import time
+
+from . import settings
+from .cache import get_cache
+
+
+def get_client_ip(request):
+    if callable(settings.CLIENT_IP):
+        return settings.CLIENT_IP(request)
+    value = request.META.get(settings.CLIENT_IP, '')
+    # the last entry was added by the closest proxy, earlier ones can be forged
+    return value.rsplit(',', 1)[-1].strip()
+
+
+def get_limits(request, user):
+    limits = []
+    if settings.THROTTLE_USER_ATTEMPTS and user is not None:
+        limits.append(
+            (f'mfa:throttle:user:{user.pk}', settings.THROTTLE_USER_ATTEMPTS)
+        )
+    if settings.THROTTLE_IP_ATTEMPTS:
+        ip = get_client_ip(request)
+        # Passkey logins are throttled by IP only because the user is not
+        # known. They need no password, so they get a separate bucket that
+        # cannot be used to block the regular login.
+        scope = 'ip' if user is not None else 'passkey-ip'
+        limits.append(
+            (f'mfa:throttle:{scope}:{ip}', settings.THROTTLE_IP_ATTEMPTS)
+        )
+    return limits
+
+
+def attempt(request, user, cost=1):
+    """Record an attempt and return False if the limit is exceeded.
+
+    Each attempt counts `cost` times, see `mfa.methods.COST_*`.
+
+    The sliding window is approximated from counters for the current and
+    the previous fixed window. Rejected attempts are not recorded.
+    """
+    limits = get_limits(request, user)
+    if not limits:
+        return True
+
+    cache = get_cache()
+    window = settings.THROTTLE_WINDOW
+    now = time.time()
+    current = int(now // window)
+    weight = 1 - (now % window) / window
+
+    keys = {}
+    for prefix, _limit in limits:
+        keys[prefix] = (f'{prefix}:{current}', f'{prefix}:{current - 1}')
+    counts = cache.get_many([key for pair in keys.values() for key in pair])
+
+    for prefix, limit in limits:
+        key, previous_key = keys[prefix]
+        count = counts.get(key, 0) + counts.get(previous_key, 0) * weight
+        if count + cost > limit:
+            return False
+
+    for key, _previous_key in keys.values():
+        if not cache.add(key, cost, window * 2):
+            try:
+                cache.incr(key, cost)
+            except ValueError:
+                cache.set(key, cost, window * 2)
+    return True
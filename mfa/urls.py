@@ -1,10 +1,13 @@
 from django.urls import path
 
 from .decorators import public
+from .views import MFAAuthAPIView
 from .views import MFAAuthView
+from .views import MFACreateAPIView
 from .views import MFACreateView
 from .views import MFADeleteView
 from .views import MFAListView
+from .views import PasskeyLoginView
 
 app_name = 'mfa'
 urlpatterns = [
@@ -12,4 +15,11 @@ urlpatterns = [
     path('<int:pk>/delete/', public(MFADeleteView.as_view()), name='delete'),
     path('create/<method>/', public(MFACreateView.as_view()), name='create'),
     path('auth/<method>/', MFAAuthView.as_view(), name='auth'),
+    path(
+        'api/create/<method>/',
+        public(MFACreateAPIView.as_view()),
+        name='api_create',
+    ),
+    path('api/auth/<method>/', MFAAuthAPIView.as_view(), name='api_auth'),
+    path('passkey/', PasskeyLoginView.as_view(), name='passkey'),
 ]
@@ -0,0 +1,54 @@
+import contextlib
+import datetime
+
+from django.db.models import F
+from django.db.models import Q
+from django.utils import timezone
+
+from . import settings
+from .cache import get_cache
+
+
+def recent_key(name):
+    return f'mfa:used_recently:{name}'
+
+
+def use_count_key(name):
+    return f'mfa:use_count:{name}'
+
+
+def count_use(cache, name):
+    key = use_count_key(name)
+    if not cache.add(key, 1, None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            # evicted in the meantime
+            cache.set(key, 1, None)
+
+
+def record_use(keys, name):
+    """Update `last_used_at` and `use_count` of `keys`.
+
+    The rows are written at most once per `USAGE_GRANULARITY`. Uses in
+    between are counted in the cache under `name` and added with the next
+    write.
+    """
+    cache = get_cache()
+    if not cache.add(recent_key(name), True, settings.USAGE_GRANULARITY):
+        count_use(cache, name)
+        return
+
+    pending = cache.get(use_count_key(name), 0)
+    now = timezone.now()
+    threshold = now - datetime.timedelta(seconds=settings.USAGE_GRANULARITY)
+    # the row may have been written by a server with a different cache
+    updated = keys.filter(
+        Q(last_used_at__isnull=True) | Q(last_used_at__lt=threshold)
+    ).update(last_used_at=now, use_count=F('use_count') + pending + 1)
+    if not updated:
+        count_use(cache, name)
+    elif pending:
+        # keep uses that were counted concurrently
+        with contextlib.suppress(ValueError):
+            cache.decr(use_count_key(name), pending)
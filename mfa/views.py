@@ -1,12 +1,17 @@
+from django.conf import settings as django_settings
 from django.contrib import messages
 from django.contrib.auth import get_user_model
+from django.contrib.auth import load_backend
 from django.contrib.auth import login
 from django.contrib.auth import user_login_failed
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.views import LoginView as DjangoLoginView
+from django.contrib.auth.views import RedirectURLMixin
+from django.core.exceptions import ValidationError
 from django.http import Http404
 from django.shortcuts import get_object_or_404
 from django.shortcuts import redirect
+from django.shortcuts import resolve_url
 from django.urls import reverse
 from django.utils.decorators import method_decorator
 from django.utils.functional import cached_property
@@ -15,40 +20,91 @@ from django.utils.translation import gettext_lazy as _
 from django.views.generic import DeleteView
 from django.views.generic import ListView
 
+from . import metrics
 from . import settings
+from . import throttle
+from .cache import keys_created
+from .cache import set_has_keys
 from .decorators import login_not_required
 from .decorators import stronghold_login_not_required
 from .forms import MFAAuthForm
 from .forms import MFACreateForm
-from .mail import send_mail
+from .mail import notify_login_failed
+from .methods import get_method
 from .mixins import MFAFormView
+from .mixins import MFAJSONMixin
 from .models import MFAKey
+from .routers import pin
+from .routers import primary
+
+
+def verify_login_code(request, user, code):
+    """Check a TOTP code that was submitted with the password.
+
+    Returns False if the code is wrong or the user is throttled.
+    """
+    method = get_method('TOTP')
+    if not throttle.attempt(request, user, method.cost):
+        return False
+    try:
+        with metrics.measure('complete', method=method.name, flow='login'):
+            method.authenticate_complete(None, user, code)
+    except ValueError:
+        user_login_failed.send(
+            sender=__name__,
+            credentials={'username': user.get_username()},
+            request=request,
+        )
+        notify_login_failed(user, method)
+        return False
+    return True
 
 
 class LoginView(DjangoLoginView):
+    """Verify the password and redirect to the second factor.
+
+    With `form_class=mfa.forms.MFALoginForm`, users with a TOTP key can
+    also enter their code in the login form and are logged in directly.
+    Otherwise, or if the code is wrong, they continue with the usual flow.
+    """
+
     def no_key_exists(self, form):
         return super().form_valid(form)
 
     def form_valid(self, form):
         user = form.get_user()
-        if not user.mfakey_set.exists():
+        enrolled = set(
+            user.mfakey_set.values_list('method', flat=True).distinct()
+        )
+        set_has_keys(user.pk, bool(enrolled))
+        if not enrolled:
             return self.no_key_exists(form)
 
+        methods = [m for m in settings.METHODS if m in enrolled]
+        code = form.cleaned_data.get('code')
+        if code and 'TOTP' in methods:
+            if verify_login_code(self.request, user, code):
+                return super().form_valid(form)
+            # let the user retry the code without the password
+            methods = ['TOTP', *(m for m in methods if m != 'TOTP')]
+
         self.request.session['mfa_user'] = {
             'pk': user.pk,
             'backend': user.backend,
         }
         self.request.session['mfa_success_url'] = self.get_success_url()
-        for method in settings.METHODS:
-            if user.mfakey_set.filter(method=method).exists():
-                return redirect('mfa:auth', method)
+        self.request.session['mfa_methods'] = methods
+        if methods:
+            return redirect('mfa:auth', methods[0])
 
 
 class MFAListView(LoginRequiredMixin, ListView):
     model = MFAKey
 
     def get_queryset(self):
-        return super().get_queryset().filter(user=self.request.user)
+        return super().get_queryset().filter(
+            user=self.request.user
+        ).defer('secret')
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -65,16 +121,26 @@ class MFADeleteView(LoginRequiredMixin, DeleteView):
     def get_success_url(self):
         return reverse('mfa:list')
 
+    def form_valid(self, form):
+        response = super().form_valid(form)
+        pin(self.request)
+        return response
+
 
 class MFACreateView(LoginRequiredMixin, MFAFormView):
     form_class = MFACreateForm
+    flow = 'create'
 
     def get_template_names(self):
-        return f'mfa/create_{self.method.name}.html'
+        return self.method.create_template
 
     def get_success_url(self):
         return reverse('mfa:list')
 
+    @property
+    def challenge_scope(self):
+        return f'create:{self.method.name}:{self.request.user.pk}'
+
     def begin(self):
         return self.method.register_begin(self.request.user)
 
@@ -82,31 +148,38 @@ class MFACreateView(LoginRequiredMixin, MFAFormView):
         return self.method.register_complete(self.challenge[1], code)
 
     def form_valid(self, form):
+        keys = self.method.build_keys(
+            self.request.user,
+            form.cleaned_data['name'],
+            form.cleaned_data['secret'],
+        )
         if settings.MAX_KEYS_PER_ACCOUNT:
-            count = self.request.user.mfakey_set.count()
-            if count >= settings.MAX_KEYS_PER_ACCOUNT:
+            with primary():
+                count = self.request.user.mfakey_set.count()
+            if count + len(keys) > settings.MAX_KEYS_PER_ACCOUNT:
                 form.add_error(None, format_lazy(_(
                     'You cannot have more than {} keys. Please delete '
                     'one of your existing keys before adding a new one.'
                 ), settings.MAX_KEYS_PER_ACCOUNT))
                 return self.form_invalid(form)
-        MFAKey.objects.create(
-            user=self.request.user,
-            method=self.method.name,
-            name=form.cleaned_data['name'],
-            secret=form.cleaned_data['secret'],
-        )
+        response = super().form_valid(form)
+        MFAKey.objects.bulk_create(keys)
+        # bulk_create() does not send post_save
+        keys_created(self.request.user.pk)
+        pin(self.request)
         messages.success(self.request, _('Key was created successfully!'))
-        return super().form_valid(form)
+        return response
 
 
 @method_decorator(login_not_required, name='dispatch')
 @method_decorator(stronghold_login_not_required, name='dispatch')
 class MFAAuthView(MFAFormView):
     form_class = MFAAuthForm
+    flow = 'auth'
+    throttled = False
 
     def get_template_names(self):
-        return f'mfa/auth_{self.method.name}.html'
+        return self.method.auth_template
 
     def get_success_url(self):
         success_url = self.request.session.pop('mfa_success_url')
@@ -126,24 +199,136 @@ class MFAAuthView(MFAFormView):
         user.backend = user_data['backend']
         return user
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['mfa_methods'] = self.request.session.get(
+            'mfa_methods', settings.METHODS
+        )
+        return context
+
+    @property
+    def challenge_scope(self):
+        return f'auth:{self.method.name}:{self.user.pk}'
+
     def begin(self):
         return self.method.authenticate_begin(self.user)
 
+    def post(self, request, *args, **kwargs):
+        self.throttled = not throttle.attempt(
+            request, self.user, self.method.cost
+        )
+        return super().post(request, *args, **kwargs)
+
     def complete(self, code):
+        if self.throttled:
+            raise ValidationError(
+                _('Too many attempts. Please try again later.'),
+                code='throttled',
+            )
         return self.method.authenticate_complete(
             self.challenge[1], self.user, code,
         )
 
     def form_invalid(self, form):
+        if self.throttled:
+            response = super().form_invalid(form)
+            response.status_code = 429
+            return response
         user_login_failed.send(
             sender=__name__,
             credentials={'username': self.user.get_username()},
             request=self.request,
         )
-        send_mail(self.user, self.method)
+        notify_login_failed(self.user, self.method)
         return super().form_invalid(form)
 
     def form_valid(self, form):
+        response = super().form_valid(form)
         login(self.request, self.user)
         del self.request.session['mfa_user']
-        return super().form_valid(form)
+        self.request.session.pop('mfa_methods', None)
+        return response
+
+
+class MFACreateAPIView(MFAJSONMixin, MFACreateView):
+    pass
+
+
+@method_decorator(login_not_required, name='dispatch')
+@method_decorator(stronghold_login_not_required, name='dispatch')
+class MFAAuthAPIView(MFAJSONMixin, MFAAuthView):
+    pass
+
+
+@method_decorator(login_not_required, name='dispatch')
+@method_decorator(stronghold_login_not_required, name='dispatch')
+class PasskeyLoginView(RedirectURLMixin, MFAFormView):
+    """Log in with a discoverable FIDO2 credential instead of a password.
+
+    Requires `MFA_PASSKEY_LOGIN`.
+    """
+
+    form_class = MFAAuthForm
+    template_name = 'mfa/login_passkey.html'
+    flow = 'passkey'
+    challenge_scope = 'passkey'
+    throttled = False
+    user = None
+
+    @property
+    def method(self):
+        if not settings.PASSKEY_LOGIN:
+            raise Http404
+        try:
+            return get_method('FIDO2')
+        except KeyError as e:
+            raise Http404 from e
+
+    def get_default_redirect_url(self):
+        return resolve_url(django_settings.LOGIN_REDIRECT_URL)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context[self.redirect_field_name] = self.get_redirect_url()
+        return context
+
+    def begin(self):
+        return self.method.passkey_begin()
+
+    def post(self, request, *args, **kwargs):
+        self.throttled = not throttle.attempt(request, None, self.method.cost)
+        return super().post(request, *args, **kwargs)
+
+    def complete(self, code):
+        if self.throttled:
+            raise ValidationError(
+                _('Too many attempts. Please try again later.'),
+                code='throttled',
+            )
+        user = self.method.passkey_complete(self.challenge[1], code)
+        if not getattr(user, 'is_active', True):
+            raise ValueError
+        # No backend authenticated the user, so use the first one that can
+        # load it. Others (e.g. for rate limiting) might not load users.
+        for backend in django_settings.AUTHENTICATION_BACKENDS:
+            if load_backend(backend).get_user(user.pk) is not None:
+                user.backend = backend
+                break
+        else:
+            raise ValueError
+        self.user = user
+
+    def form_invalid(self, form):
+        response = super().form_invalid(form)
+        if self.throttled:
+            response.status_code = 429
+        else:
+            user_login_failed.send(
+                sender=__name__, credentials={}, request=self.request
+            )
+        return response
+
+    def form_valid(self, form):
+        response = super().form_valid(form)
+        login(self.request, self.user)
+        return response
@@ -0,0 +1,18 @@
+from django.contrib.auth.decorators import login_required
+from django.urls import include
+from django.urls import path
+
+from mfa.async_views import LoginView
+from mfa.forms import MFALoginForm
+
+from .urls import dummy
+
+urlpatterns = [
+    path('', login_required(dummy)),
+    path('login/', LoginView.as_view()),
+    path('login/code/', LoginView.as_view(form_class=MFALoginForm)),
+    path('login/redirect/', LoginView.as_view(
+        redirect_authenticated_user=True, extra_context={'title': 'Log in'}
+    )),
+    path('mfa/', include('mfa.async_urls', namespace='mfa')),
+]
@@ -0,0 +1,8 @@
+class NoUserBackend:
+    """Like django-axes, which has to come first but does not load users."""
+
+    def authenticate(self, request, **credentials):
+        return None
+
+    def get_user(self, user_id):
+        return None
@@ -0,0 +1,30 @@
+from mfa.methods import COST_LOW
+from mfa.models import MFAKey
+
+name = 'dummy'
+auth_template = 'mfa/auth_TOTP.html'
+create_template = 'mfa/create_TOTP.html'
+cost = COST_LOW
+
+
+def register_begin(user):
+    return {'url': 'dummy', 'secret': 'dummy'}, 'dummy'
+
+
+def register_complete(state, request_data):
+    if request_data != state:
+        raise ValueError
+    return state
+
+
+def build_keys(user, key_name, secret):
+    return [MFAKey(user=user, method=name, name=key_name, secret=secret)]
+
+
+def authenticate_begin(user):
+    return None, None
+
+
+def authenticate_complete(state, user, request_data):
+    if not user.mfakey_set.filter(method=name, secret=request_data).exists():
+        raise ValueError
@@ -8,7 +8,12 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': ':memory:',
-    }
+    },
+    # an empty stand-in for a replica, see RouterTest
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    },
 }
 
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
@@ -74,3 +79,6 @@ DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
 
 MFA_DOMAIN = 'localhost'
 MFA_SITE_TITLE = 'Tests'
+MFA_MAIL_DISPATCHER = 'mfa.mail.dispatch_sync'
+MFA_METHODS = ['FIDO2', 'TOTP', 'recovery', 'dummy']
+MFA_METHOD_MODULES = {'dummy': 'tests.dummy_method'}
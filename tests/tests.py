@@ -1,18 +1,76 @@
+import base64
+import hashlib
+import io
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+from unittest import mock
+from unittest import skipIf
+
+import django
 import pyotp
+import qrcode
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from django.conf import settings
+from django.contrib.auth.hashers import check_password
+from django.contrib.auth.hashers import get_hasher
 from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import User
 from django.core import mail
+from django.core.cache import cache
+from django.core.exceptions import DisallowedHost
+from django.core.management import call_command
+from django.db import connection
+from django.db import connections
+from django.test import Client
 from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils.module_loading import import_string
+from fido2.cose import ES256
 from fido2.server import _verify_origin_for_rp
-
+from fido2.utils import websafe_decode
+from fido2.utils import websafe_encode
+from fido2.webauthn import AttestedCredentialData
+from fido2.webauthn import AuthenticatorData
+from fido2.webauthn import CollectedClientData
+
+from mfa import async_views
+from mfa import metrics
+from mfa import usage
+from mfa.admin import revoke_keys
+from mfa.cache import has_keys
+from mfa.cache import has_keys_key
+from mfa.challenges import SessionStore
+from mfa.challenges import SignedStore
+from mfa.mail import dispatch_in_thread
+from mfa.mail import notify_login_failed
+from mfa.mail import send_digest
 from mfa.mail import send_mail
+from mfa.methods import current_host
 from mfa.methods import fido2
+from mfa.methods import get_method
+from mfa.methods import recovery
+from mfa.methods import totp
 from mfa.models import MFAKey
+from mfa.routers import primary
+from mfa.templatetags.mfa import cache_clear as qrcode_cache_clear
 from mfa.templatetags.mfa import get_qrcode
+from mfa.templatetags.mfa import render_qrcode
 
 
 class MFATestCase(TestCase):
     def setUp(self):
+        cache.clear()
         self.user = User.objects.create_user('test', password='password')
 
     def login(self):
@@ -83,6 +141,372 @@ class TOTPAuthViewTest(MFATestCase):
         self.assertEqual(res.status_code, 200)
         self.assert_not_logged_in()
 
+    def test_replay(self):
+        counter = totp.get_counters()[0]
+        code = pyotp.HOTP(self.key.secret).at(counter)
+        with mock.patch('mfa.settings.TOTP_VALID_WINDOW', 1):
+            totp.authenticate_complete(None, self.user, code)
+            with self.assertRaises(ValueError):
+                totp.authenticate_complete(None, self.user, code)
+
+        self.key.refresh_from_db()
+        self.assertEqual(self.key.last_counter, counter)
+        self.assertIsNotNone(self.key.last_used_at)
+        self.assertEqual(self.key.use_count, 1)
+
+    def test_no_older_code_after_newer(self):
+        counter = totp.get_counters()[0]
+        hotp = pyotp.HOTP(self.key.secret)
+        with mock.patch('mfa.settings.TOTP_VALID_WINDOW', 1):
+            totp.authenticate_complete(None, self.user, hotp.at(counter))
+            with self.assertRaises(ValueError):
+                totp.authenticate_complete(None, self.user, hotp.at(counter - 1))
+            totp.authenticate_complete(None, self.user, hotp.at(counter + 1))
+
+
+class LoginViewTest(MFATestCase):
+    def test_single_query_for_method_selection(self):
+        for method in ['recovery', 'TOTP', 'FIDO2']:
+            MFAKey.objects.create(
+                user=self.user,
+                method=method,
+                name='test',
+                secret='mock',
+            )
+
+        with CaptureQueriesContext(connection) as ctx:
+            res = self.login()
+        self.assertEqual(res.status_code, 302)
+        self.assertEqual(res.url, '/mfa/auth/FIDO2/')
+        queries = [q for q in ctx.captured_queries if 'mfa_mfakey' in q['sql']]
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(
+            self.client.session['mfa_methods'], ['FIDO2', 'TOTP', 'recovery']
+        )
+
+    def test_only_link_enrolled_methods(self):
+        MFAKey.objects.create(
+            user=self.user,
+            method='TOTP',
+            name='test',
+            secret=pyotp.random_base32(),
+        )
+        self.login()
+        res = self.client.get('/mfa/auth/TOTP/')
+        self.assertNotContains(res, '/mfa/auth/FIDO2/')
+        self.assertNotContains(res, '/mfa/auth/recovery/')
+
+    def login_with_code(self, code):
+        return self.client.post('/login/code/', {
+            'username': 'test',
+            'password': 'password',
+            'code': code,
+        })
+
+    def test_code_in_login_form(self):
+        key = MFAKey.objects.create(
+            user=self.user,
+            method='TOTP',
+            name='test',
+            secret=pyotp.random_base32(),
+        )
+        res = self.login_with_code(pyotp.TOTP(key.secret).now())
+        self.assertEqual(res.status_code, 302)
+        self.assertEqual(res.url, '/')
+        self.assertNotIn('mfa_user', self.client.session)
+        res = self.client.get('/')
+        self.assertEqual(res.status_code, 204)
+
+    def test_wrong_code_in_login_form(self):
+        for method in ['FIDO2', 'TOTP']:
+            MFAKey.objects.create(
+                user=self.user,
+                method=method,
+                name='test',
+                secret=pyotp.random_base32(),
+            )
+        with mock.patch('mfa.views.notify_login_failed') as notify:
+            res = self.login_with_code('123456')
+        self.assertEqual(res.status_code, 302)
+        self.assertEqual(res.url, '/mfa/auth/TOTP/')
+        self.assertEqual(self.client.session['mfa_methods'], ['TOTP', 'FIDO2'])
+        notify.assert_called_once()
+        self.assert_not_logged_in()
+
+    def test_replayed_code_in_login_form(self):
+        key = MFAKey.objects.create(
+            user=self.user,
+            method='TOTP',
+            name='test',
+            secret=pyotp.random_base32(),
+        )
+        code = pyotp.TOTP(key.secret).now()
+        self.login_with_code(code)
+        self.client.logout()
+        res = self.login_with_code(code)
+        self.assertEqual(res.url, '/mfa/auth/TOTP/')
+
+    def test_code_in_login_form_other_method(self):
+        MFAKey.objects.create(
+            user=self.user, method='FIDO2', name='test', secret='mock'
+        )
+        with mock.patch('mfa.views.notify_login_failed') as notify:
+            res = self.login_with_code('123456')
+        self.assertEqual(res.url, '/mfa/auth/FIDO2/')
+        notify.assert_not_called()
+
+    def test_code_in_login_form_throttled(self):
+        key = MFAKey.objects.create(
+            user=self.user,
+            method='TOTP',
+            name='test',
+            secret=pyotp.random_base32(),
+        )
+        with mock.patch('mfa.settings.THROTTLE_USER_ATTEMPTS', 0.5):
+            res = self.login_with_code(pyotp.TOTP(key.secret).now())
+        self.assertEqual(res.url, '/mfa/auth/TOTP/')
+
+
+class ThrottleTest(MFATestCase):
+    def setUp(self):
+        super().setUp()
+        self.key = MFAKey.objects.create(
+            user=self.user,
+            method='TOTP',
+            name='test',
+            secret=pyotp.random_base32(),
+        )
+        self.login()
+        self.client.get('/mfa/auth/TOTP/')
+
+    def test_user_limit(self):
+        with (
+            mock.patch('mfa.settings.THROTTLE_USER_ATTEMPTS', 2),
+            mock.patch(
+                'mfa.methods.totp.authenticate_complete', side_effect=ValueError
+            ) as complete,
+            mock.patch('mfa.views.notify_login_failed') as notify,
+        ):
+            for _ in range(2):
+                res = self.client.post('/mfa/auth/TOTP/', {'code': '123456'})
+                self.assertEqual(res.status_code, 200)
+
+            res = self.client.post('/mfa/auth/TOTP/', {'code': '123456'})
+            self.assertEqual(res.status_code, 429)
+            self.assertContains(res, 'Too many attempts', status_code=429)
+
+        self.assertEqual(complete.call_count, 2)
+        self.assertEqual(notify.call_count, 2)
+
+    def test_ip_limit(self):
+        with (
+            mock.patch('mfa.settings.THROTTLE_IP_ATTEMPTS', 1),
+            mock.patch('mfa.settings.THROTTLE_USER_ATTEMPTS', None),
+        ):
+            res = self.client.post('/mfa/auth/TOTP/', {'code': '123456'})
+            self.assertEqual(res.status_code, 200)
+            res = self.client.post('/mfa/auth/TOTP/', {'code': '123456'})
+            self.assertEqual(res.status_code, 429)
+            res = self.client.post(
+                '/mfa/auth/TOTP/', {'code': '123456'}, REMOTE_ADDR='127.0.0.2'
+            )
+            self.assertEqual(res.status_code, 200)
+
+    def test_client_ip_header(self):
+        with (
+            mock.patch('mfa.settings.THROTTLE_IP_ATTEMPTS', 1),
+            mock.patch('mfa.settings.THROTTLE_USER_ATTEMPTS', None),
+            mock.patch('mfa.settings.CLIENT_IP', 'HTTP_X_FORWARDED_FOR'),
+        ):
+            res = self.client.post(
+                '/mfa/auth/TOTP/',
+                {'code': '123456'},
+                HTTP_X_FORWARDED_FOR='10.0.0.1, 192.0.2.1',
+            )
+            self.assertEqual(res.status_code, 200)
+            # a forged first entry does not select another bucket
+            res = self.client.post(
+                '/mfa/auth/TOTP/',
+                {'code': '123456'},
+                HTTP_X_FORWARDED_FOR='10.0.0.2, 192.0.2.1',
+            )
+            self.assertEqual(res.status_code, 429)
+            res = self.client.post(
+                '/mfa/auth/TOTP/',
+                {'code': '123456'},
+                HTTP_X_FORWARDED_FOR='192.0.2.2',
+            )
+            self.assertEqual(res.status_code, 200)
+
+    def test_client_ip_callable(self):
+        with (
+            mock.patch('mfa.settings.THROTTLE_IP_ATTEMPTS', 1),
+            mock.patch('mfa.settings.THROTTLE_USER_ATTEMPTS', None),
+            mock.patch(
+                'mfa.settings.CLIENT_IP',
+                lambda request: request.META['HTTP_X_REAL_IP'],
+            ),
+        ):
+            for ip, status_code in [
+                ('192.0.2.1', 200), ('192.0.2.1', 429), ('192.0.2.2', 200)
+            ]:
+                res = self.client.post(
+                    '/mfa/auth/TOTP/', {'code': '123456'}, HTTP_X_REAL_IP=ip
+                )
+                self.assertEqual(res.status_code, status_code)
+
+    def test_cost(self):
+        self.client.logout()
+        MFAKey.objects.create(
+            user=self.user, method='recovery', name='test', secret='dummy'
+        )
+        self.login()
+        self.client.get('/mfa/auth/recovery/')
+        with mock.patch('mfa.settings.THROTTLE_USER_ATTEMPTS', 4):
+            for _ in range(2):
+                res = self.client.post('/mfa/auth/recovery/', {'code': '1'})
+                self.assertEqual(res.status_code, 200)
+            res = self.client.post('/mfa/auth/recovery/', {'code': '1'})
+            self.assertEqual(res.status_code, 429)
+
+    def test_window(self):
+        with (
+            mock.patch('mfa.settings.THROTTLE_USER_ATTEMPTS', 1),
+            mock.patch('time.time', return_value=1000.0),
+        ):
+            self.client.post('/mfa/auth/TOTP/', {'code': '123456'})
+            res = self.client.post('/mfa/auth/TOTP/', {'code': '123456'})
+            self.assertEqual(res.status_code, 429)
+
+        with (
+            mock.patch('mfa.settings.THROTTLE_USER_ATTEMPTS', 1),
+            mock.patch('time.time', return_value=1000.0 + 2 * 300),
+        ):
+            res = self.client.post('/mfa/auth/TOTP/', {'code': '123456'})
+            self.assertEqual(res.status_code, 200)
+
+
+class MethodRegistryTest(MFATestCase):
+    def test_custom_method(self):
+        self.client.force_login(self.user)
+        res = self.client.get('/mfa/create/dummy/')
+        self.assertEqual(res.status_code, 200)
+        res = self.client.post('/mfa/create/dummy/', {
+            'name': 'test',
+            'code': 'dummy',
+        })
+        self.assertEqual(res.status_code, 302)
+        self.assertEqual(MFAKey.objects.get().method, 'dummy')
+
+        self.client.logout()
+        res = self.login()
+        self.assertEqual(res.url, '/mfa/auth/dummy/')
+        self.client.get(res.url)
+        res = self.client.post(res.url, {'code': 'dummy'})
+        self.assertEqual(res.status_code, 302)
+        self.assertEqual(res.url, '/')
+
+    def test_not_enabled(self):
+        with mock.patch('mfa.settings.METHODS', ['TOTP']):
+            with self.assertRaises(KeyError):
+                get_method('dummy')
+
+
+class ChallengeStoreTest(MFATestCase):
+    stores = ['mfa.challenges.CacheStore', 'mfa.challenges.SignedStore']
+
+    def setUp(self):
+        super().setUp()
+        self.key = MFAKey.objects.create(
+            user=self.user,
+            method='TOTP',
+            name='test',
+            secret=pyotp.random_base32(),
+        )
+        self.hotp = pyotp.HOTP(self.key.secret)
+
+    def test_happy_flow(self):
+        for store in self.stores:
+            with (
+                self.subTest(store=store),
+                mock.patch('mfa.settings.CHALLENGE_STORE', store),
+            ):
+                self.client.logout()
+                MFAKey.objects.update(last_counter=None)
+                self.login()
+                res = self.client.get('/mfa/auth/TOTP/')
+                token = res.context['form']['challenge'].value()
+                self.assertTrue(token)
+                self.assertNotIn('mfa_challenges', self.client.session)
+
+                res = self.client.post('/mfa/auth/TOTP/', {
+                    'code': 'invalid',
+                    'challenge': token,
+                })
+                self.assertEqual(res.status_code, 200)
+                self.assertContains(res, token)
+
+                res = self.client.post('/mfa/auth/TOTP/', {
+                    'code': self.hotp.at(totp.get_counters()[0]),
+                    'challenge': token,
+                })
+                self.assertEqual(res.status_code, 302)
+                self.assertEqual(res.url, '/')
+
+    def test_single_use(self):
+        for store in self.stores:
+            with (
+                self.subTest(store=store),
+                mock.patch('mfa.settings.CHALLENGE_STORE', store),
+            ):
+                self.login()
+                res = self.client.get('/mfa/auth/TOTP/')
+                token = res.context['form']['challenge'].value()
+                scope = f'auth:TOTP:{self.user.pk}'
+                challenge_store = import_string(store)()
+                challenge_store.delete(None, scope, token)
+                with self.assertRaises(KeyError):
+                    challenge_store.load(None, scope, token)
+                with self.assertRaises(KeyError):
+                    challenge_store.delete(None, scope, token)
+
+    def test_wrong_scope(self):
+        for store in ['mfa.challenges.SessionStore', *self.stores]:
+            with self.subTest(store=store):
+                request = SimpleNamespace(session={})
+                challenge_store = import_string(store)()
+                token = challenge_store.save(
+                    request, 'auth:TOTP:1', [None, None]
+                )
+                with self.assertRaises(KeyError):
+                    challenge_store.load(request, 'auth:TOTP:2', token)
+                with self.assertRaises(KeyError):
+                    challenge_store.delete(request, 'auth:TOTP:2', token)
+                challenge_store.load(request, 'auth:TOTP:1', token)
+
+    def test_session_scopes(self):
+        request = SimpleNamespace(session={})
+        challenge_store = SessionStore()
+        challenge_store.save(request, 'auth:TOTP:1', ['auth', None])
+        challenge_store.save(request, 'create:TOTP:1', ['create', None])
+        challenge_store.delete(request, 'create:TOTP:1', '')
+        self.assertEqual(
+            challenge_store.load(request, 'auth:TOTP:1', ''), ['auth', None]
+        )
+
+    def test_signed_expired(self):
+        challenge_store = SignedStore()
+        token = challenge_store.save(None, 'scope', [None, None])
+        with mock.patch('mfa.settings.CHALLENGE_TIMEOUT', -1):
+            with self.assertRaises(KeyError):
+                challenge_store.load(None, 'scope', token)
+
+    def test_signed_tampered(self):
+        challenge_store = SignedStore()
+        token = challenge_store.save(None, 'scope', [None, None])
+        with self.assertRaises(KeyError):
+            challenge_store.load(None, 'scope', token[:-1])
+
 
 class TOTPCreateViewTest(MFATestCase):
     def test_happy_flow(self):
@@ -189,6 +613,58 @@ class TOTPCreateViewTest(MFATestCase):
         self.assertEqual(MFAKey.objects.count(), 3)
 
 
+class SoftAuthenticator:
+    def __init__(self):
+        self.private_key = ec.generate_private_key(ec.SECP256R1())
+        self.credential_id = os.urandom(32)
+        self.credential = AttestedCredentialData.create(
+            b'\0' * 16,
+            self.credential_id,
+            ES256.from_cryptography_key(self.private_key.public_key()),
+        )
+        self.counter = 0
+
+    @property
+    def secret(self):
+        return websafe_encode(self.credential)
+
+    def get(
+        self,
+        options,
+        rp_id='localhost',
+        origin='http://localhost',
+        user_handle=None,
+        user_verified=True,
+    ):
+        self.counter += 1
+        challenge = json.loads(options)['publicKey']['challenge']
+        client_data = CollectedClientData.create(
+            type='webauthn.get',
+            challenge=websafe_decode(challenge),
+            origin=origin,
+        )
+        auth_data = AuthenticatorData.create(
+            hashlib.sha256(rp_id.encode()).digest(),
+            AuthenticatorData.FLAG.UP
+            | (AuthenticatorData.FLAG.UV if user_verified else 0),
+            self.counter,
+        )
+        signature = self.private_key.sign(
+            auth_data + client_data.hash, ec.ECDSA(hashes.SHA256())
+        )
+        return json.dumps({
+            'id': websafe_encode(self.credential_id),
+            'rawId': websafe_encode(self.credential_id),
+            'type': 'public-key',
+            'response': {
+                'clientDataJSON': websafe_encode(client_data),
+                'authenticatorData': websafe_encode(auth_data),
+                'signature': websafe_encode(signature),
+                'userHandle': user_handle and websafe_encode(user_handle),
+            },
+        })
+
+
 class FIDO2Test(MFATestCase):
     # I have no clue how to simulate a FIDO2 authenticator,
     # so these are just some smoke tests.
@@ -209,6 +685,94 @@ class FIDO2Test(MFATestCase):
         res = self.client.get('/mfa/create/FIDO2/')
         self.assertEqual(res.status_code, 200)
 
+    def test_authenticate(self):
+        authenticator = SoftAuthenticator()
+        key, = fido2.build_keys(self.user, 'test', authenticator.secret)
+        key.save()
+        self.assertEqual(
+            key.credential_id,
+            hashlib.sha256(authenticator.credential_id).hexdigest(),
+        )
+
+        for _ in range(2):
+            self.client.logout()
+            self.login()
+            res = self.client.get('/mfa/auth/FIDO2/')
+            code = authenticator.get(res.context['mfa_data'])
+            with CaptureQueriesContext(connection) as ctx:
+                res = self.client.post('/mfa/auth/FIDO2/', {'code': code})
+            self.assertEqual(res.status_code, 302)
+            self.assertEqual(res.url, '/')
+
+        # the first login records usage, the second only counts it in cache
+        queries = [
+            query['sql'] for query in ctx.captured_queries
+            if 'mfa_mfakey' in query['sql']
+        ]
+        self.assertEqual(len(queries), 1)
+        self.assertTrue(queries[0].startswith('SELECT'))
+
+    def test_stale_credential_cache(self):
+        authenticator = SoftAuthenticator()
+        key, = fido2.build_keys(self.user, 'test', authenticator.secret)
+        key.save()
+        data, state = fido2.authenticate_begin(self.user)
+        # delete without invalidating, like on a server with another cache
+        MFAKey.objects.filter(pk=key.pk).raw_delete()
+        with self.assertRaises(ValueError):
+            fido2.authenticate_complete(
+                state, self.user, authenticator.get(data)
+            )
+
+    def test_usage(self):
+        authenticator = SoftAuthenticator()
+        key, = fido2.build_keys(self.user, 'test', authenticator.secret)
+        key.save()
+
+        def authenticate():
+            data, state = fido2.authenticate_begin(self.user)
+            fido2.authenticate_complete(
+                state, self.user, authenticator.get(data)
+            )
+            key.refresh_from_db()
+
+        authenticate()
+        self.assertIsNotNone(key.last_used_at)
+        self.assertEqual(key.use_count, 1)
+        last_used_at = key.last_used_at
+
+        authenticate()
+        authenticate()
+        self.assertEqual(key.last_used_at, last_used_at)
+        self.assertEqual(key.use_count, 1)
+
+        with mock.patch('mfa.settings.USAGE_GRANULARITY', 0):
+            cache.delete(usage.recent_key(f'{self.user.pk}:{key.credential_id}'))
+            authenticate()
+        self.assertGreater(key.last_used_at, last_used_at)
+        self.assertEqual(key.use_count, 4)
+
+    def test_authenticate_unknown_credential(self):
+        authenticator = SoftAuthenticator()
+        other = SoftAuthenticator()
+        fido2.build_keys(self.user, 'test', authenticator.secret)[0].save()
+
+        data, state = fido2.authenticate_begin(self.user)
+        with self.assertRaises(ValueError):
+            fido2.authenticate_complete(state, self.user, other.get(data))
+
+    def test_deleted_credential(self):
+        authenticator = SoftAuthenticator()
+        key, = fido2.build_keys(self.user, 'test', authenticator.secret)
+        key.save()
+
+        data, state = fido2.authenticate_begin(self.user)
+        key.delete()
+        with self.assertRaises(ValueError):
+            fido2.authenticate_complete(
+                state, self.user, authenticator.get(data)
+            )
+
     def test_origin_https(self):
         for domain, value, expected in [
             ('example.com', 'https://example.com', True),
@@ -226,6 +790,231 @@ class FIDO2Test(MFATestCase):
                 self.assertEqual(verify(value), expected)
 
 
+@override_settings(ALLOWED_HOSTS=['*'])
+@mock.patch('mfa.settings.RELYING_PARTIES', {
+    'tenant.localhost': ('tenant.localhost', 'Tenant'),
+    'testserver': ('localhost', 'Tests'),
+})
+class FIDO2RelyingPartyTest(MFATestCase):
+    def test_get_relying_party(self):
+        self.assertEqual(
+            fido2.get_relying_party('tenant.localhost:8000'),
+            ('tenant.localhost', 'Tenant'),
+        )
+        with self.assertRaises(DisallowedHost):
+            fido2.get_relying_party('other.localhost')
+        with mock.patch('mfa.settings.RELYING_PARTIES', {}):
+            self.assertEqual(
+                fido2.get_relying_party('other.localhost'),
+                ('localhost', 'Tests'),
+            )
+        with mock.patch(
+            'mfa.settings.RELYING_PARTIES', lambda host: (host, host.upper())
+        ):
+            self.assertEqual(
+                fido2.get_relying_party('other.localhost'),
+                ('other.localhost', 'OTHER.LOCALHOST'),
+            )
+
+    def test_server_cache(self):
+        def get_server(host):
+            token = current_host.set(host)
+            try:
+                return fido2.get_server()
+            finally:
+                current_host.reset(token)
+
+        server = get_server('tenant.localhost')
+        self.assertEqual(server.rp.id, 'tenant.localhost')
+        self.assertIs(get_server('tenant.localhost:8000'), server)
+        self.assertEqual(get_server('testserver').rp.id, 'localhost')
+
+    def test_authenticate(self):
+        authenticator = SoftAuthenticator()
+        fido2.build_keys(self.user, 'test', authenticator.secret)[0].save()
+
+        self.client.post('/login/', {
+            'username': 'test',
+            'password': 'password',
+        }, HTTP_HOST='tenant.localhost')
+        res = self.client.get('/mfa/auth/FIDO2/', HTTP_HOST='tenant.localhost')
+        self.assertEqual(
+            json.loads(res.context['mfa_data'])['publicKey']['rpId'],
+            'tenant.localhost',
+        )
+        code = authenticator.get(
+            res.context['mfa_data'],
+            rp_id='tenant.localhost',
+            origin='http://tenant.localhost',
+        )
+        res = self.client.post(
+            '/mfa/auth/FIDO2/', {'code': code}, HTTP_HOST='tenant.localhost'
+        )
+        self.assertEqual(res.status_code, 302)
+        self.assertEqual(res.url, '/')
+
+    def test_unknown_host(self):
+        self.client.force_login(self.user)
+        res = self.client.get('/mfa/create/FIDO2/', HTTP_HOST='other.localhost')
+        self.assertEqual(res.status_code, 400)
+
+
+@mock.patch('mfa.settings.PASSKEY_LOGIN', True)
+class PasskeyLoginTest(MFATestCase):
+    def setUp(self):
+        super().setUp()
+        self.authenticator = SoftAuthenticator()
+        key, = fido2.build_keys(self.user, 'test', self.authenticator.secret)
+        key.save()
+        self.user_handle = str(self.user.pk).encode()
+
+    def test_login(self):
+        res = self.client.get('/mfa/passkey/?next=/mfa/')
+        self.assertEqual(res.status_code, 200)
+        options = json.loads(res.context['mfa_data'])['publicKey']
+        self.assertEqual(options['allowCredentials'], [])
+        self.assertEqual(options['userVerification'], 'required')
+
+        code = self.authenticator.get(
+            res.context['mfa_data'], user_handle=self.user_handle
+        )
+        with CaptureQueriesContext(connection) as ctx:
+            res = self.client.post(
+                '/mfa/passkey/', {'code': code, 'next': '/mfa/'}
+            )
+        self.assertEqual(res.status_code, 302)
+        self.assertEqual(res.url, '/mfa/')
+        self.assertEqual(
+            int(self.client.session['_auth_user_id']), self.user.pk
+        )
+        # no password check and no lookup by username
+        for query in ctx.captured_queries:
+            self.assertNotIn('auth_user"."username" =', query['sql'])
+
+    def test_user_verification_required(self):
+        # even if the state does not require it
+        data, state = fido2.get_server().authenticate_begin([])
+        code = self.authenticator.get(
+            json.dumps(dict(data)),
+            user_handle=self.user_handle,
+            user_verified=False,
+        )
+        with self.assertRaises(ValueError):
+            fido2.passkey_complete(state, code)
+
+    def test_other_challenge(self):
+        attacker = User.objects.create_user('attacker')
+        MFAKey.objects.create(
+            user=attacker, method='TOTP', name='test', secret='dummy'
+        )
+        self.client.force_login(attacker)
+        res = self.client.get('/mfa/create/FIDO2/')
+        data = json.loads(res.context['mfa_data'])['publicKey']
+        code = self.authenticator.get(
+            json.dumps({'publicKey': data}),
+            user_handle=self.user_handle,
+            user_verified=False,
+        )
+        res = self.client.post('/mfa/passkey/', {'code': code})
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(
+            int(self.client.session['_auth_user_id']), attacker.pk
+        )
+
+    def test_wrong_user_handle(self):
+        other = User.objects.create_user('other')
+        res = self.client.get('/mfa/passkey/')
+        code = self.authenticator.get(
+            res.context['mfa_data'], user_handle=str(other.pk).encode()
+        )
+        res = self.client.post('/mfa/passkey/', {'code': code})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('_auth_user_id', self.client.session)
+
+    def test_unknown_credential(self):
+        res = self.client.get('/mfa/passkey/')
+        code = SoftAuthenticator().get(
+            res.context['mfa_data'], user_handle=self.user_handle
+        )
+        res = self.client.post('/mfa/passkey/', {'code': code})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('_auth_user_id', self.client.session)
+
+    def test_inactive_user(self):
+        self.user.is_active = False
+        self.user.save()
+        res = self.client.get('/mfa/passkey/')
+        code = self.authenticator.get(
+            res.context['mfa_data'], user_handle=self.user_handle
+        )
+        res = self.client.post('/mfa/passkey/', {'code': code})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('_auth_user_id', self.client.session)
+
+    def test_throttle(self):
+        with mock.patch('mfa.settings.THROTTLE_IP_ATTEMPTS', 1):
+            res = self.client.get('/mfa/passkey/')
+            code = SoftAuthenticator().get(
+                res.context['mfa_data'], user_handle=self.user_handle
+            )
+            self.client.post('/mfa/passkey/', {'code': code})
+            code = self.authenticator.get(
+                res.context['mfa_data'], user_handle=self.user_handle
+            )
+            res = self.client.post('/mfa/passkey/', {'code': code})
+        self.assertEqual(res.status_code, 429)
+
+    def test_throttle_separate_bucket(self):
+        with mock.patch('mfa.settings.THROTTLE_IP_ATTEMPTS', 1):
+            res = self.client.get('/mfa/passkey/')
+            code = SoftAuthenticator().get(
+                res.context['mfa_data'], user_handle=self.user_handle
+            )
+            self.client.post('/mfa/passkey/', {'code': code})
+
+            # the password login from the same IP is not affected
+            totp_key = MFAKey.objects.create(
+                user=self.user,
+                method='TOTP',
+                name='test',
+                secret=pyotp.random_base32(),
+            )
+            self.login()
+            self.client.get('/mfa/auth/TOTP/')
+            res = self.client.post('/mfa/auth/TOTP/', {
+                'code': pyotp.TOTP(totp_key.secret).now(),
+            })
+        self.assertEqual(res.status_code, 302)
+
+    def test_backend(self):
+        with override_settings(AUTHENTICATION_BACKENDS=[
+            'tests.backends.NoUserBackend',
+            'django.contrib.auth.backends.ModelBackend',
+        ]):
+            res = self.client.get('/mfa/passkey/')
+            code = self.authenticator.get(
+                res.context['mfa_data'], user_handle=self.user_handle
+            )
+            res = self.client.post('/mfa/passkey/', {'code': code})
+            self.assertEqual(res.status_code, 302)
+            res = self.client.get('/')
+            self.assertEqual(res.status_code, 204)
+        self.assertEqual(
+            self.client.session['_auth_user_backend'],
+            'django.contrib.auth.backends.ModelBackend',
+        )
+
+    def test_register_resident_key(self):
+        data, _state = fido2.register_begin(self.user)
+        selection = json.loads(data)['publicKey']['authenticatorSelection']
+        self.assertEqual(selection['residentKey'], 'preferred')
+
+    def test_disabled(self):
+        with mock.patch('mfa.settings.PASSKEY_LOGIN', False):
+            res = self.client.get('/mfa/passkey/')
+        self.assertEqual(res.status_code, 404)
+
+
 class RecoveryTest(MFATestCase):
     def test_create(self):
         self.client.force_login(self.user)
@@ -249,6 +1038,75 @@ class RecoveryTest(MFATestCase):
         self.assertEqual(res.url, '/mfa/')
 
         self.assertEqual(MFAKey.objects.count(), 1)
+        key = MFAKey.objects.get()
+        self.assertEqual(key.lookup, recovery.get_lookup(code))
+
+    def test_create_sheet(self):
+        self.client.force_login(self.user)
+
+        with (
+            mock.patch('mfa.settings.RECOVERY_CODES_PER_SHEET', 5),
+            mock.patch('mfa.settings.MAX_KEYS_PER_ACCOUNT', 6),
+        ):
+            res = self.client.get('/mfa/create/recovery/')
+            codes = res.context['mfa_data']['codes']
+            self.assertEqual(len(codes), 5)
+            self.assertEqual(len(set(codes)), 5)
+
+            res = self.client.post('/mfa/create/recovery/', {
+                'name': 'test',
+                'code': codes[0],
+            })
+            self.assertEqual(res.status_code, 302)
+
+        self.assertEqual(MFAKey.objects.count(), 5)
+        for code in codes:
+            recovery.authenticate_complete(None, self.user, code)
+        self.assertEqual(MFAKey.objects.count(), 0)
+
+    def test_create_sheet_max_keys(self):
+        self.client.force_login(self.user)
+
+        with mock.patch('mfa.settings.RECOVERY_CODES_PER_SHEET', 5):
+            res = self.client.get('/mfa/create/recovery/')
+            res = self.client.post('/mfa/create/recovery/', {
+                'name': 'test',
+                'code': res.context['mfa_data']['code'],
+            })
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(MFAKey.objects.count(), 0)
+
+    def test_secret_key_rotation(self):
+        code = '11111-11111'
+        state = [[recovery.get_lookup(code), make_password(code)]]
+        MFAKey.objects.bulk_create(recovery.build_keys(self.user, 'test', state))
+
+        with override_settings(
+            SECRET_KEY='rotated', SECRET_KEY_FALLBACKS=[settings.SECRET_KEY]
+        ):
+            self.assertNotEqual(recovery.get_lookup(code), state[0][0])
+            recovery.authenticate_complete(None, self.user, code)
+        self.assertEqual(MFAKey.objects.count(), 0)
+
+    def test_authenticate_checks_single_hash(self):
+        codes = ['11111-11111', '22222-22222', '33333-33333']
+        for code in codes:
+            state = [[recovery.get_lookup(code), make_password(code)]]
+            MFAKey.objects.bulk_create(
+                recovery.build_keys(self.user, 'test', state)
+            )
+
+        with mock.patch(
+            'mfa.methods.recovery.check_password', wraps=check_password
+        ) as check:
+            with self.assertRaises(ValueError):
+                recovery.authenticate_complete(None, self.user, 'invalid')
+            self.assertEqual(check.call_count, 0)
+
+            recovery.authenticate_complete(None, self.user, codes[2])
+            self.assertEqual(check.call_count, 1)
+
+        self.assertEqual(MFAKey.objects.count(), 2)
 
     def test_authenticate(self):
         MFAKey.objects.create(
@@ -283,6 +1141,71 @@ class RecoveryTest(MFATestCase):
         self.assertEqual(MFAKey.objects.count(), 1)
 
 
+class APITest(MFATestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = Client(enforce_csrf_checks=True)
+
+    def post(self, url, data):
+        return self.client.post(
+            url, data, HTTP_X_CSRFTOKEN=self.client.cookies['csrftoken'].value
+        )
+
+    def test_auth(self):
+        key = MFAKey.objects.create(
+            user=self.user,
+            method='TOTP',
+            name='test',
+            secret=pyotp.random_base32(),
+        )
+        self.client.get('/login/')
+        self.post('/login/', {'username': 'test', 'password': 'password'})
+
+        res = self.client.get('/mfa/api/auth/TOTP/')
+        self.assertEqual(res.status_code, 200)
+        data = res.json()
+        self.assertEqual(data['method'], 'TOTP')
+        self.assertEqual(data['methods'], ['TOTP'])
+        self.assertIn('csrftoken', res.cookies)
+
+        res = self.client.post('/mfa/api/auth/TOTP/', {'code': '123456'})
+        self.assertEqual(res.status_code, 403)
+
+        res = self.post('/mfa/api/auth/TOTP/', {
+            'code': 'invalid',
+            'challenge': data['challenge'],
+        })
+        self.assertEqual(res.status_code, 400)
+        self.assertIn('__all__', res.json()['errors'])
+
+        res = self.post('/mfa/api/auth/TOTP/', {
+            'code': pyotp.TOTP(key.secret).now(),
+            'challenge': data['challenge'],
+        })
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json(), {'redirect': '/'})
+        self.assertEqual(self.client.get('/').status_code, 204)
+
+    def test_create(self):
+        self.client.force_login(self.user)
+        res = self.client.get('/mfa/api/create/recovery/')
+        self.assertEqual(res.status_code, 200)
+        data = res.json()
+
+        res = self.post('/mfa/api/create/recovery/', {
+            'name': 'recovery',
+            'code': data['mfa_data']['code'],
+            'challenge': data['challenge'],
+        })
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json(), {'redirect': '/mfa/'})
+        self.assertEqual(MFAKey.objects.count(), 1)
+
+    def test_no_auth_without_login(self):
+        res = self.client.get('/mfa/api/auth/TOTP/')
+        self.assertEqual(res.status_code, 404)
+
+
 class MFAEnforceMiddlewareTest(MFATestCase):
     def test_redirect(self):
         self.login()
@@ -296,6 +1219,49 @@ class MFAEnforceMiddlewareTest(MFATestCase):
         self.assertEqual(res.status_code, 302)
         self.assertEqual(res.url, '/')
 
+    def test_no_queries_in_steady_state(self):
+        key = MFAKey.objects.create(
+            user=self.user,
+            method='TOTP',
+            name='test',
+            secret=pyotp.random_base32(),
+        )
+        self.client.force_login(self.user)
+        self.client.get('/')
+
+        with CaptureQueriesContext(connection) as ctx:
+            res = self.client.get('/')
+        self.assertEqual(res.status_code, 204)
+        for query in ctx.captured_queries:
+            self.assertNotIn('mfa_mfakey', query['sql'])
+
+        key.delete()
+        res = self.client.get('/')
+        self.assertEqual(res.status_code, 302)
+        self.assertEqual(res.url, '/mfa/')
+
+    def test_cache_timeout(self):
+        self.client.force_login(self.user)
+        with mock.patch('mfa.settings.CACHE_TIMEOUT', 0):
+            self.client.get('/')
+        self.assertIsNone(cache.get(has_keys_key(self.user.pk)))
+        self.client.get('/')
+        self.assertIs(cache.get(has_keys_key(self.user.pk)), False)
+
+    def test_redirect_stops_after_key_creation(self):
+        self.client.force_login(self.user)
+        res = self.client.get('/')
+        self.assertEqual(res.status_code, 302)
+
+        MFAKey.objects.create(
+            user=self.user,
+            method='TOTP',
+            name='test',
+            secret=pyotp.random_base32(),
+        )
+        res = self.client.get('/')
+        self.assertEqual(res.status_code, 204)
+
 
 class PatchAdminTest(TestCase):
     def test_root(self):
@@ -322,6 +1288,94 @@ class PatchAdminTest(TestCase):
         self.assertEqual(res.url, '/login/?next=/admin/')
 
 
+class MFAKeyAdminTest(MFATestCase):
+    def setUp(self):
+        super().setUp()
+        self.admin = User.objects.create_superuser('admin', password='password')
+        self.other = User.objects.create_user('other', password='password')
+        for user in [self.admin, self.user, self.other]:
+            for method in ['TOTP', 'recovery']:
+                MFAKey.objects.create(
+                    user=user, method=method, name=method, secret='secret'
+                )
+        self.client.force_login(self.admin)
+
+    def test_changelist_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            res = self.client.get('/admin/mfa/mfakey/')
+        self.assertEqual(res.status_code, 200)
+        sql = '\n'.join(q['sql'] for q in ctx.captured_queries)
+        self.assertNotIn('"secret"', sql)
+        self.assertNotIn('DISTINCT', sql)
+
+        for user in range(5):
+            MFAKey.objects.create(
+                user=User.objects.create_user(f'user{user}'),
+                method='TOTP',
+                name='TOTP',
+                secret='secret',
+            )
+        with self.assertNumQueries(len(ctx.captured_queries)):
+            self.client.get('/admin/mfa/mfakey/')
+
+    def test_search(self):
+        res = self.client.get('/admin/mfa/mfakey/', {'q': 'oth'})
+        self.assertEqual(
+            {key.user for key in res.context['cl'].result_list}, {self.other}
+        )
+
+    def test_search_name(self):
+        res = self.client.get('/admin/mfa/mfakey/', {'q': 'TOT'})
+        self.assertEqual(
+            {key.name for key in res.context['cl'].result_list}, {'TOTP'}
+        )
+
+    def test_revoke_all(self):
+        key = self.user.mfakey_set.first()
+        with mock.patch('mfa.signals.cache.invalidate') as invalidate:
+            res = self.client.post('/admin/mfa/mfakey/', {
+                'action': 'revoke_all',
+                '_selected_action': [key.pk],
+            })
+        self.assertEqual(res.status_code, 302)
+        invalidate.assert_not_called()
+        self.assertFalse(self.user.mfakey_set.exists())
+        self.assertEqual(MFAKey.objects.count(), 4)
+
+    def test_revoke_method(self):
+        keys = MFAKey.objects.filter(user=self.other)
+        res = self.client.post('/admin/mfa/mfakey/', {
+            'action': 'revoke_TOTP',
+            '_selected_action': list(keys.values_list('pk', flat=True)),
+        })
+        self.assertEqual(res.status_code, 302)
+        self.assertEqual(list(keys.values_list('method', flat=True)), ['recovery'])
+        self.assertEqual(MFAKey.objects.count(), 5)
+
+    def test_method_choices(self):
+        key = self.user.mfakey_set.first()
+        res = self.client.get(f'/admin/mfa/mfakey/{key.pk}/change/')
+        self.assertEqual(res.status_code, 200)
+        field = res.context['adminform'].form.fields['method']
+        self.assertEqual(
+            [value for value, _label in field.choices], settings.MFA_METHODS
+        )
+
+        key.method = 'HOTP'
+        key.save()
+        res = self.client.get(f'/admin/mfa/mfakey/{key.pk}/change/')
+        field = res.context['adminform'].form.fields['method']
+        self.assertIn(('HOTP', 'HOTP'), field.choices)
+
+    def test_revoke_invalidates_cache(self):
+        self.assertTrue(has_keys(self.other))
+        self.client.post('/admin/mfa/mfakey/', {
+            'action': 'revoke_all',
+            '_selected_action': [self.other.mfakey_set.first().pk],
+        })
+        self.assertFalse(has_keys(self.other))
+
+
 class ListViewTest(MFATestCase):
     def test_list_view(self):
         self.client.force_login(self.user)
@@ -335,6 +1389,38 @@ class ListViewTest(MFATestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(res.content.count(b'<li>'), 1)
 
+    def test_list_view_queries(self):
+        self.client.force_login(self.user)
+        MFAKey.objects.create(
+            user=self.user, method='TOTP', name='test', secret='secret'
+        )
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get('/mfa/')
+        for query in ctx.captured_queries:
+            self.assertNotIn('"secret"', query['sql'])
+
+
+class QueryPlanTest(TestCase):
+    def explain(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            return ' '.join(row[-1] for row in cursor.fetchall())
+
+    def test_user_method_index(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('uses SQLite query plans')
+        user = User.objects.create_user('test')
+        for queryset in [
+            user.mfakey_set.filter(method='TOTP').values_list('pk', 'secret'),
+            user.mfakey_set.filter(method='FIDO2', credential_id='x'),
+            user.mfakey_set.values_list('method', flat=True).distinct(),
+        ]:
+            with self.subTest(sql=str(queryset.query)):
+                self.assertIn(
+                    'mfa_mfakey_user_method_idx', self.explain(queryset)
+                )
+
 
 class DeleteViewTest(MFATestCase):
     def test_delete_view(self):
@@ -351,12 +1437,409 @@ class DeleteViewTest(MFATestCase):
         self.assertEqual(MFAKey.objects.filter(pk=key.pk).count(), 0)
 
 
+class ImportExportTest(MFATestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def write_jsonl(self, records):
+        path = os.path.join(self.tmpdir.name, 'keys.jsonl')
+        with open(path, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+        return path
+
+    def test_import(self):
+        secret = bytes(range(20))
+        path = self.write_jsonl([
+            {
+                'username': 'test',
+                'method': 'TOTP',
+                'name': 'otp',
+                'secret': secret.hex(),
+            },
+            {
+                'username': 'test',
+                'method': 'recovery',
+                'name': 'recovery',
+                'secret': '12345-67890',
+            },
+            {
+                'username': 'unknown',
+                'method': 'TOTP',
+                'name': 'otp',
+                'secret': secret.hex(),
+            },
+            {'username': 'test', 'method': 'INVALID'},
+        ])
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        call_command(
+            'mfa_import', path, '--totp-hex', '--hash-recovery-codes',
+            '--batch-size', '2', stdout=stdout, stderr=stderr,
+        )
+        self.assertIn('Imported 2 keys (2 skipped)', stdout.getvalue())
+        self.assertIn('record 3: unknown user', stderr.getvalue())
+
+        key = MFAKey.objects.get(method='TOTP')
+        self.assertEqual(base64.b32decode(key.secret), secret)
+        recovery.authenticate_complete(None, self.user, '12345-67890')
+        self.assertFalse(MFAKey.objects.filter(method='recovery').exists())
+
+    def test_import_max_keys(self):
+        path = self.write_jsonl([
+            {
+                'username': 'test',
+                'method': 'TOTP',
+                'name': f'otp{i}',
+                'secret': pyotp.random_base32(),
+            }
+            for i in range(5)
+        ])
+        with mock.patch('mfa.settings.MAX_KEYS_PER_ACCOUNT', 3):
+            call_command(
+                'mfa_import', path, '--batch-size', '2',
+                stdout=io.StringIO(), stderr=io.StringIO(),
+            )
+        self.assertEqual(MFAKey.objects.count(), 3)
+
+    def test_import_invalidates_cache(self):
+        self.assertFalse(has_keys(self.user))
+        path = self.write_jsonl([{
+            'username': 'test',
+            'method': 'TOTP',
+            'name': 'otp',
+            'secret': pyotp.random_base32(),
+        }])
+        call_command('mfa_import', path, stdout=io.StringIO())
+        self.assertTrue(has_keys(self.user))
+
+    def test_roundtrip(self):
+        MFAKey.objects.create(
+            user=self.user,
+            method='recovery',
+            name='recovery',
+            secret=make_password('12345-67890'),
+            lookup=recovery.get_lookup('12345-67890'),
+        )
+        MFAKey.objects.create(
+            user=self.user,
+            method='TOTP',
+            name='otp',
+            secret=pyotp.random_base32(),
+        )
+        expected = set(MFAKey.objects.values_list(
+            'method', 'name', 'secret', 'lookup'
+        ))
+        for fmt in ['csv', 'jsonl']:
+            with self.subTest(fmt=fmt):
+                path = os.path.join(self.tmpdir.name, f'keys.{fmt}')
+                call_command('mfa_export', path, stdout=io.StringIO())
+                MFAKey.objects.all().delete()
+                call_command('mfa_import', path, stdout=io.StringIO())
+                self.assertEqual(set(MFAKey.objects.values_list(
+                    'method', 'name', 'secret', 'lookup'
+                )), expected)
+
+    def test_export_file_mode(self):
+        path = os.path.join(self.tmpdir.name, 'keys.jsonl')
+        call_command('mfa_export', path, stdout=io.StringIO())
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+
+
+@override_settings(PASSWORD_HASHERS=[
+    'django.contrib.auth.hashers.MD5PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+])
+class RecoveryAuditTest(MFATestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = User.objects.create_user('other')
+        self.current = MFAKey.objects.create(
+            user=self.user,
+            method='recovery',
+            name='recovery',
+            secret=make_password('12345-67890'),
+        )
+        MFAKey.objects.create(
+            user=self.user,
+            method='recovery',
+            name='recovery',
+            secret=get_hasher('pbkdf2_sha1').encode(
+                '23456-78901', 'salt', iterations=1
+            ),
+        )
+        MFAKey.objects.create(
+            user=self.other, method='recovery', name='recovery', secret='x'
+        )
+
+    def test_report(self):
+        stdout = io.StringIO()
+        call_command('mfa_recovery_audit', stdout=stdout)
+        output = stdout.getvalue()
+        self.assertIn('md5: 1\npbkdf2_sha1: 1\nunknown: 1\n', output)
+        self.assertIn('2 outdated codes of 2 users', output)
+        self.assertEqual(MFAKey.objects.count(), 3)
+
+    def test_workers(self):
+        # worker processes do not see override_settings()
+        stdout = io.StringIO()
+        call_command('mfa_recovery_audit', '--workers', '2', stdout=stdout)
+        self.assertIn('2 outdated codes of 2 users', stdout.getvalue())
+
+    def test_invalidate(self):
+        call_command(
+            'mfa_recovery_audit', '--invalidate', stdout=io.StringIO()
+        )
+        self.assertEqual(list(MFAKey.objects.all()), [self.current])
+
+    def test_reissue(self):
+        path = os.path.join(tempfile.mkdtemp(), 'sheets.jsonl')
+        self.addCleanup(os.remove, path)
+        call_command(
+            'mfa_recovery_audit', '--reissue', path, stdout=io.StringIO()
+        )
+        with open(path) as f:
+            sheets = {
+                sheet['username']: sheet['codes']
+                for sheet in map(json.loads, f)
+            }
+        self.assertEqual(set(sheets), {'test', 'other'})
+        self.assertEqual(MFAKey.objects.count(), 3)
+        recovery.authenticate_complete(None, self.other, sheets['other'][0])
+        recovery.authenticate_complete(None, self.user, sheets['test'][0])
+        recovery.authenticate_complete(None, self.user, '12345-67890')
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+
+    def test_reissue_max_keys(self):
+        path = os.path.join(tempfile.mkdtemp(), 'sheets.jsonl')
+        self.addCleanup(os.remove, path)
+        stderr = io.StringIO()
+        with mock.patch('mfa.settings.MAX_KEYS_PER_ACCOUNT', 1):
+            call_command(
+                'mfa_recovery_audit', '--reissue', path,
+                stdout=io.StringIO(), stderr=stderr,
+            )
+        self.assertIn('Skipped 1 users', stderr.getvalue())
+        self.assertIn(': test', stderr.getvalue())
+        self.assertEqual(self.user.mfakey_set.count(), 1)
+        self.assertEqual(self.other.mfakey_set.count(), 1)
+
+
+@override_settings(DATABASE_ROUTERS=['mfa.routers.MFARouter'])
+@mock.patch('mfa.settings.READ_DATABASE', 'replica')
+class RouterTest(MFATestCase):
+    databases = {'default', 'replica'}
+
+    def get_sql(self, alias, func):
+        with CaptureQueriesContext(connections[alias]) as ctx:
+            func()
+        return '\n'.join(query['sql'] for query in ctx.captured_queries)
+
+    def test_db_for_read(self):
+        self.assertEqual(MFAKey.objects.all().db, 'replica')
+        self.assertEqual(self.user.mfakey_set.all().db, 'replica')
+        self.assertEqual(User.objects.all().db, 'default')
+        with primary():
+            self.assertEqual(MFAKey.objects.all().db, 'default')
+
+    def test_max_keys_count_on_primary(self):
+        self.client.force_login(self.user)
+        res = self.client.get('/mfa/create/TOTP/')
+        secret = res.context['mfa_data']['secret']
+
+        def create():
+            self.client.post('/mfa/create/TOTP/', {
+                'name': 'test',
+                'code': pyotp.TOTP(secret).now(),
+            })
+
+        sql = self.get_sql('default', create)
+        self.assertIn('COUNT(*)', sql)
+        self.assertTrue(self.user.mfakey_set.using('default').exists())
+        self.assertIn('mfa_primary_until', self.client.session)
+
+    def test_recovery_replica_lag(self):
+        code = '12345-67890'
+        User.objects.using('replica').create(pk=self.user.pk, username='test')
+        key = MFAKey.objects.using('replica').create(
+            user_id=self.user.pk,
+            method='recovery',
+            name='recovery',
+            secret=make_password(code),
+            lookup=recovery.get_lookup(code),
+        )
+        # already used (deleted) on the primary
+        self.assertFalse(MFAKey.objects.using('default').filter(pk=key.pk).exists())
+        with self.assertRaises(ValueError):
+            recovery.authenticate_complete(None, self.user, code)
+        self.assertTrue(MFAKey.objects.using('replica').filter(pk=key.pk).exists())
+
+    def test_revoke_keys_on_primary(self):
+        MFAKey.objects.create(
+            user=self.user, method='TOTP', name='test', secret='secret'
+        )
+        revoke_keys(
+            mock.Mock(), None, MFAKey.objects.using('default').all()
+        )
+        self.assertFalse(MFAKey.objects.using('default').exists())
+
+    def test_recovery_audit_on_primary(self):
+        User.objects.using('replica').create(pk=self.user.pk, username='test')
+        for alias in ['default', 'replica']:
+            MFAKey.objects.using(alias).create(
+                pk=1,
+                user_id=self.user.pk,
+                method='recovery',
+                name='recovery',
+                secret='x',
+            )
+        call_command(
+            'mfa_recovery_audit', '--invalidate', stdout=io.StringIO()
+        )
+        self.assertFalse(MFAKey.objects.using('default').exists())
+
+    def test_pin(self):
+        self.client.force_login(self.user)
+        cache.set(has_keys_key(self.user.pk), True)
+        middleware = [
+            *settings.MIDDLEWARE, 'mfa.middleware.MFAPrimaryPinMiddleware'
+        ]
+        with self.settings(MIDDLEWARE=middleware):
+            sql = self.get_sql('replica', lambda: self.client.get('/mfa/'))
+            self.assertIn('mfa_mfakey', sql)
+
+            session = self.client.session
+            session['mfa_primary_until'] = time.time() + 30
+            session.save()
+            sql = self.get_sql('replica', lambda: self.client.get('/mfa/'))
+            self.assertNotIn('mfa_mfakey', sql)
+
+
+@mock.patch('mfa.settings.METRICS', 'mfa.metrics.registry')
+class MetricsTest(MFATestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.registry.clear()
+        self.key = MFAKey.objects.create(
+            user=self.user,
+            method='TOTP',
+            name='test',
+            secret=pyotp.random_base32(),
+        )
+
+    def test_auth(self):
+        code = pyotp.TOTP(self.key.secret).now()
+        for _ in range(2):
+            self.client.logout()
+            self.login()
+            self.client.get('/mfa/auth/TOTP/')
+            self.client.post('/mfa/auth/TOTP/', {'code': 'invalid'})
+            self.client.post('/mfa/auth/TOTP/', {'code': code})
+
+        output = metrics.registry.render()
+        labels = 'method="TOTP",flow="auth"'
+        self.assertIn('# TYPE mfa_begin_seconds histogram', output)
+        self.assertIn(f'mfa_begin_seconds_count{{{labels}}} 2', output)
+        self.assertIn(f'mfa_complete_queries_bucket{{{labels},le="+Inf"}} 4', output)
+        self.assertIn(f'mfa_complete_total{{{labels},outcome="success"}} 1', output)
+        self.assertIn(f'mfa_complete_total{{{labels},outcome="replay"}} 1', output)
+        self.assertIn(f'mfa_complete_total{{{labels},outcome="failure"}} 2', output)
+
+    def test_signal(self):
+        receiver = mock.Mock()
+        metrics.metric_recorded.connect(receiver)
+        self.addCleanup(metrics.metric_recorded.disconnect, receiver)
+        with self.assertRaises(ValueError), metrics.measure('test', foo='bar'):
+            raise ValueError
+        receiver.assert_any_call(
+            signal=metrics.metric_recorded,
+            sender='mfa.metrics',
+            kind='counter',
+            name='mfa_test_total',
+            labels={'foo': 'bar', 'outcome': 'failure'},
+            value=1,
+        )
+
+    def test_disabled(self):
+        receiver = mock.Mock()
+        metrics.metric_recorded.connect(receiver)
+        self.addCleanup(metrics.metric_recorded.disconnect, receiver)
+        with mock.patch('mfa.settings.METRICS', None):
+            with metrics.measure('test'):
+                pass
+            res = self.client.get('/metrics/')
+        receiver.assert_not_called()
+        self.assertEqual(res.status_code, 404)
+
+    def test_view(self):
+        res = self.client.get('/metrics/')
+        self.assertEqual(res.status_code, 404)
+
+        get_qrcode('test')
+        with self.settings(INTERNAL_IPS=['127.0.0.1']):
+            res = self.client.get('/metrics/')
+        self.assertEqual(res.status_code, 200)
+        self.assertContains(res, 'mfa_qrcode_total{outcome="success"} 1')
+
+
 class QRCodeTest(TestCase):
     def test_is_svg(self):
         code = get_qrcode('some_data')
         self.assertTrue(code.startswith('<svg'))
         self.assertTrue(code.endswith('</svg>'))
 
+    def test_single_path(self):
+        code = get_qrcode('some_data')
+        self.assertEqual(code.count('<path'), 1)
+
+        qr = qrcode.QRCode(border=4)
+        qr.add_data('some_data')
+        matrix = qr.get_matrix()
+        widths = re.findall(r'h(\d+)', code)
+        self.assertEqual(
+            sum(int(w) for w in widths), sum(sum(row) for row in matrix)
+        )
+
+    def test_cached(self):
+        qrcode_cache_clear()
+        with mock.patch(
+            'mfa.templatetags.mfa.render_qrcode', wraps=render_qrcode
+        ) as render:
+            get_qrcode('some_data')
+            get_qrcode('some_data')
+        self.assertEqual(render.call_count, 1)
+
+    def test_cache_expires(self):
+        qrcode_cache_clear()
+        with mock.patch(
+            'mfa.templatetags.mfa.render_qrcode', wraps=render_qrcode
+        ) as render:
+            with mock.patch('time.monotonic', return_value=1000.0):
+                get_qrcode('some_data')
+            with mock.patch('time.monotonic', return_value=1000.0 + 59):
+                get_qrcode('some_data')
+            self.assertEqual(render.call_count, 1)
+            with mock.patch('time.monotonic', return_value=1000.0 + 60):
+                get_qrcode('some_data')
+            self.assertEqual(render.call_count, 2)
+
+    def test_cache_size(self):
+        qrcode_cache_clear()
+        with (
+            mock.patch(
+                'mfa.templatetags.mfa.render_qrcode', wraps=render_qrcode
+            ) as render,
+            mock.patch('mfa.templatetags.mfa.CACHE_SIZE', 2),
+        ):
+            # 'a' is used again, so 'b' is evicted
+            for data in ['a', 'b', 'a', 'c', 'a']:
+                get_qrcode(data)
+            self.assertEqual(render.call_count, 3)
+            get_qrcode('b')
+        self.assertEqual(render.call_count, 4)
+
 
 class MailTest(TestCase):
     def setUp(self):
@@ -382,3 +1865,320 @@ accident, you may ignore this email.
 
 If this was not you, we strongly recommend to change your password.
 """)
+
+
+class MailDigestTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            'test', password='password', email='test@example.com'
+        )
+
+    def test_coalesce(self):
+        notify_login_failed(self.user, totp)
+        self.assertEqual(len(mail.outbox), 1)
+
+        with mock.patch('mfa.mail.dispatch_sync') as dispatch:
+            for _ in range(3):
+                notify_login_failed(self.user, totp)
+        dispatch.assert_called_once_with(
+            send_digest, self.user.pk, 'TOTP', delay=300
+        )
+        self.assertEqual(len(mail.outbox), 1)
+
+        send_digest(self.user.pk, 'TOTP')
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertIn('We detected 3 attempts', mail.outbox[1].body)
+
+    def test_first_attempt_immediately(self):
+        with mock.patch('mfa.mail.dispatch_sync') as dispatch:
+            notify_login_failed(self.user, totp)
+        dispatch.assert_called_once_with(
+            send_digest, self.user.pk, 'TOTP', delay=0
+        )
+
+    def test_new_window_after_digest(self):
+        notify_login_failed(self.user, totp)
+        notify_login_failed(self.user, totp)
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_auth_view(self):
+        MFAKey.objects.create(
+            user=self.user,
+            method='TOTP',
+            name='test',
+            secret=pyotp.random_base32(),
+        )
+        self.client.post('/login/', {
+            'username': 'test',
+            'password': 'password',
+        })
+        self.client.get('/mfa/auth/TOTP/')
+        with mock.patch('mfa.mail.dispatch_sync') as dispatch:
+            for _ in range(2):
+                self.client.post('/mfa/auth/TOTP/', {'code': 'invalid'})
+        self.assertEqual(dispatch.call_count, 1)
+
+
+class MailThreadTest(TransactionTestCase):
+    def test_dispatch_in_thread(self):
+        user = User.objects.create_user(
+            'test', password='password', email='test@example.com'
+        )
+        cache.clear()
+        with (
+            mock.patch('mfa.settings.MAIL_DISPATCHER', 'mfa.mail.dispatch_in_thread'),
+            mock.patch('mfa.settings.MAIL_WINDOW', 0),
+        ):
+            notify_login_failed(user, totp)
+
+        for _ in range(100):
+            if mail.outbox:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_delay(self):
+        func = mock.Mock()
+        dispatch_in_thread(func, 1, delay=0.01)
+        for _ in range(100):
+            if func.called:
+                break
+            time.sleep(0.01)
+        func.assert_called_once_with(1)
+
+    def test_single_scheduler_thread(self):
+        func = mock.Mock()
+        for i in range(10):
+            dispatch_in_thread(func, i, delay=0.05 - i * 0.005)
+        threads = [
+            thread for thread in threading.enumerate()
+            if thread.name == 'mfa-mail-scheduler'
+        ]
+        self.assertEqual(len(threads), 1)
+        for _ in range(100):
+            if func.call_count == 10:
+                break
+            time.sleep(0.01)
+        self.assertEqual(func.call_count, 10)
+
+
+@skipIf(django.VERSION < (5, 1), 'async views require Django 5.1')
+@override_settings(ROOT_URLCONF='tests.async_urls')
+class AsyncViewTest(MFATestCase):
+    async def alogin(self):
+        return await self.async_client.post('/login/', {
+            'username': 'test',
+            'password': 'password',
+        })
+
+    async def test_login_without_keys(self):
+        res = await self.alogin()
+        self.assertEqual(res.status_code, 302)
+        self.assertEqual(res.url, '/')
+
+    async def test_login_context(self):
+        res = await self.async_client.get('/login/redirect/')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.context['site_name'], 'testserver')
+        self.assertEqual(res.context['title'], 'Log in')
+
+    async def test_redirect_authenticated_user(self):
+        await MFAKey.objects.acreate(
+            user=self.user, method='TOTP', name='test', secret='dummy'
+        )
+        await self.async_client.aforce_login(self.user)
+        res = await self.async_client.get('/login/redirect/')
+        self.assertEqual(res.status_code, 302)
+        self.assertEqual(res.url, '/')
+
+    async def test_code_in_login_form(self):
+        key = await MFAKey.objects.acreate(
+            user=self.user,
+            method='TOTP',
+            name='test',
+            secret=pyotp.random_base32(),
+        )
+        res = await self.async_client.post('/login/code/', {
+            'username': 'test',
+            'password': 'password',
+            'code': pyotp.TOTP(key.secret).now(),
+        })
+        self.assertEqual(res.status_code, 302)
+        self.assertEqual(res.url, '/')
+        res = await self.async_client.get('/')
+        self.assertEqual(res.status_code, 204)
+
+    async def test_auth_happy_flow(self):
+        key = await MFAKey.objects.acreate(
+            user=self.user,
+            method='TOTP',
+            name='test',
+            secret=pyotp.random_base32(),
+        )
+        res = await self.alogin()
+        self.assertEqual(res.status_code, 302)
+        self.assertEqual(res.url, '/mfa/auth/TOTP/')
+
+        res = await self.async_client.get('/mfa/auth/TOTP/')
+        self.assertEqual(res.status_code, 200)
+        challenge = res.context['form'].initial['challenge']
+
+        res = await self.async_client.post('/mfa/auth/TOTP/', {
+            'code': pyotp.TOTP(key.secret).now(),
+            'challenge': challenge,
+        })
+        self.assertEqual(res.status_code, 302)
+        self.assertEqual(res.url, '/')
+
+        res = await self.async_client.get('/')
+        self.assertEqual(res.status_code, 204)
+
+    async def test_auth_loads_user_once(self):
+        await MFAKey.objects.acreate(
+            user=self.user,
+            method='TOTP',
+            name='test',
+            secret=pyotp.random_base32(),
+        )
+        await self.alogin()
+        await self.async_client.get('/mfa/auth/TOTP/')
+        with mock.patch.object(
+            async_views.MFAAuthView,
+            'setup_user',
+            autospec=True,
+            side_effect=async_views.MFAAuthView.setup_user,
+        ) as setup_user:
+            await self.async_client.post('/mfa/auth/TOTP/', {'code': '123456'})
+        self.assertEqual(setup_user.call_count, 1)
+
+    async def test_auth_wrong_code(self):
+        await MFAKey.objects.acreate(
+            user=self.user,
+            method='TOTP',
+            name='test',
+            secret=pyotp.random_base32(),
+        )
+        await self.alogin()
+        res = await self.async_client.get('/mfa/auth/TOTP/')
+        challenge = res.context['form'].initial['challenge']
+
+        res = await self.async_client.post('/mfa/auth/TOTP/', {
+            'code': 'invalid',
+            'challenge': challenge,
+        })
+        self.assertEqual(res.status_code, 200)
+        res = await self.async_client.get('/')
+        self.assertEqual(res.status_code, 302)
+
+    async def test_no_auth_without_login(self):
+        res = await self.async_client.get('/mfa/auth/TOTP/')
+        self.assertEqual(res.status_code, 404)
+
+    async def test_create_happy_flow(self):
+        await self.async_client.aforce_login(self.user)
+
+        res = await self.async_client.get('/mfa/create/recovery/')
+        self.assertEqual(res.status_code, 200)
+        mfa_data = res.context['mfa_data']
+        challenge = res.context['form'].initial['challenge']
+
+        res = await self.async_client.post('/mfa/create/recovery/', {
+            'name': 'test',
+            'code': mfa_data['code'],
+            'challenge': challenge,
+        })
+        self.assertEqual(res.status_code, 302)
+        self.assertEqual(res.url, '/mfa/')
+        self.assertEqual(await MFAKey.objects.acount(), 1)
+
+    async def test_challenge_store_single_use(self):
+        for store in ['mfa.challenges.CacheStore', 'mfa.challenges.SignedStore']:
+            with self.subTest(store=store):
+                challenge_store = import_string(store)()
+                token = await challenge_store.asave(None, 'scope', [1, 2])
+                self.assertEqual(
+                    await challenge_store.aload(None, 'scope', token), [1, 2]
+                )
+                await challenge_store.adelete(None, 'scope', token)
+                with self.assertRaises(KeyError):
+                    await challenge_store.aload(None, 'scope', token)
+                with self.assertRaises(KeyError):
+                    await challenge_store.adelete(None, 'scope', token)
+
+    async def test_create_not_logged_in(self):
+        res = await self.async_client.get('/mfa/create/TOTP/')
+        self.assertEqual(res.status_code, 302)
+        self.assertEqual(res.url, '/login/?next=/mfa/create/TOTP/')
+
+    async def test_same_routes(self):
+        for name, kwargs in [
+            ('api_create', {'method': 'TOTP'}),
+            ('api_auth', {'method': 'TOTP'}),
+            ('passkey', {}),
+        ]:
+            with self.subTest(name=name):
+                self.assertEqual(
+                    reverse(f'mfa:{name}', kwargs=kwargs),
+                    reverse(f'mfa:{name}', 'tests.urls', kwargs=kwargs),
+                )
+
+    async def test_api_auth(self):
+        key = await MFAKey.objects.acreate(
+            user=self.user,
+            method='TOTP',
+            name='test',
+            secret=pyotp.random_base32(),
+        )
+        await self.alogin()
+        res = await self.async_client.get('/mfa/api/auth/TOTP/')
+        self.assertEqual(res.status_code, 200)
+        res = await self.async_client.post('/mfa/api/auth/TOTP/', {
+            'code': pyotp.TOTP(key.secret).now(),
+            'challenge': res.json()['challenge'],
+        })
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json(), {'redirect': '/'})
+
+
+IMPORT_SCRIPT = """
+import django
+import tests.settings
+
+tests.settings.MFA_METHODS = ['TOTP']
+django.setup()
+
+import mfa.middleware
+import mfa.templatetags.mfa
+import mfa.urls
+import mfa.views
+from mfa.methods import get_method
+
+get_method('TOTP')
+
+from django.db.migrations.loader import MigrationLoader
+
+MigrationLoader(None)
+"""
+
+
+class ImportTimeTest(TestCase):
+    def get_imported_modules(self, script):
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', script],
+            env={**os.environ, 'DJANGO_SETTINGS_MODULE': 'tests.settings'},
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        modules = set()
+        for line in result.stderr.splitlines():
+            if line.startswith('import time:') and '|' in line:
+                modules.add(line.rsplit('|', 1)[1].strip())
+        return modules
+
+    def test_unused_backends_are_not_imported(self):
+        modules = self.get_imported_modules(IMPORT_SCRIPT)
+        self.assertIn('pyotp', modules)
+        for name in ['fido2', 'cryptography', 'qrcode']:
+            self.assertNotIn(name, modules)
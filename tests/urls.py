@@ -6,6 +6,8 @@ from django.urls import include
 from django.urls import path
 
 from mfa.decorators import public
+from mfa.forms import MFALoginForm
+from mfa.metrics import metrics_view
 from mfa.views import LoginView
 
 
@@ -16,7 +18,9 @@ def dummy(request):
 urlpatterns = [
     path('', login_required(dummy)),
     path('login/', LoginView.as_view()),
+    path('login/code/', LoginView.as_view(form_class=MFALoginForm)),
     path('logout/', public(LogoutView.as_view(next_page='/'))),
     path('admin/', admin.site.urls),
     path('mfa/', include('mfa.urls', namespace='mfa')),
+    path('metrics/', metrics_view),
 ]